@@ -0,0 +1,273 @@
+from __future__ import with_statement
+import os, re, errno, bisect, threading, logging, time
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from compressor import Compressor
+
+# Rotated files are named <log file>.<BACKUP_STAMP>, see LogFile.do_rotate()
+BACKUP_STAMP = '%Y-%m-%d-%H-%M-%S-%f'
+
+# Regexes for the numeric strftime directives. Other directives match any text.
+STRFTIME_REGEXES = {
+    'Y': r'\d{4}',
+    'y': r'\d{2}',
+    'm': r'\d{2}',
+    'd': r'\d{2}',
+    'j': r'\d{3}',
+    'H': r'\d{2}',
+    'I': r'\d{2}',
+    'M': r'\d{2}',
+    'S': r'\d{2}',
+    'f': r'\d{6}',
+    'U': r'\d{2}',
+    'W': r'\d{2}',
+    'w': r'\d',
+    '%': '%',
+}
+
+def strftime_regex(pattern):
+    '''Returns a regex matching the strings that the strftime pattern produces.'''
+
+    result = []
+    for part in re.split(r'(%.)', pattern):
+        if len(part) == 2 and part[0] == '%':
+            result.append(STRFTIME_REGEXES.get(part[1], r'.+?'))
+        else:
+            result.append(re.escape(part))
+
+    return ''.join(result)
+
+class BackupIndex(object):
+    '''Keeps track of the rotated backups of log files.
+
+    Each directory is listed once, the first time one of its files is rotated,
+    and the index is kept up to date as backups are added and removed, so that
+    applying the retention policy does not have to list the directory again.
+
+    Backups are indexed by the name of the log file they were rotated from
+    and recorded under their name before compression. The compressor adds
+    its extension at some later point, so remove_old() tries all of them.
+
+    Backups are named <log file>.<suffix>, where the suffix is formatted with
+    BACKUP_STAMP or one of the strftime patterns passed to add_pattern().
+    Suffixes must sort in chronological order.
+    '''
+
+    EXTENSIONS = tuple(sorted(Compressor.COMPRESS_EXTS.values()))
+
+    def __init__(self):
+        '''Initializes an empty index.'''
+
+        self.log = logging.getLogger('backups') # internal logger
+        self.lock = threading.Lock()
+
+        self.dirs = {} # directory -> {log file basename -> sorted list of backup basenames}
+        self.patterns = [] # (strftime pattern, regex matching <log file>.<suffix>)
+
+        self.add_pattern(BACKUP_STAMP)
+
+    def add_pattern(self, pattern):
+        '''Makes the index recognize backups named with the strftime pattern.'''
+
+        with self.lock:
+            if pattern in [p for p, _ in self.patterns]:
+                return
+
+            self.patterns.append((pattern, re.compile(r'^(.+)\.' + strftime_regex(pattern) + '$')))
+
+            # Directories listed so far may hold backups with this pattern
+            self.dirs = {}
+
+    def add(self, filename, backup):
+        '''Records that the log file filename was rotated to backup.
+
+        Both are full paths, without any compression extension.'''
+
+        dirname, name = os.path.split(filename)
+        backup = os.path.basename(backup)
+
+        with self.lock:
+            backups = self.get_dir(dirname).setdefault(name, [])
+
+            i = bisect.bisect_left(backups, backup)
+            if i == len(backups) or backups[i] != backup:
+                backups.insert(i, backup)
+
+    def remove_old(self, filename, keep, current=None):
+        '''Removes all but the newest keep backups of the log file filename.
+
+        current is the file being written to, when it is named like a backup.
+        It is not counted, and never removed.'''
+
+        dirname, name = os.path.split(filename)
+
+        with self.lock:
+            backups = self.get_dir(dirname).get(name, [])
+
+            if current is not None and backups and backups[-1] == os.path.basename(current):
+                to_remove = backups[:-(keep + 1)]
+            else:
+                to_remove = backups[:-keep]
+            del backups[:len(to_remove)]
+
+            for backup in to_remove:
+                self.unlink(os.path.join(dirname, backup))
+
+    def unlink(self, filename):
+        '''Removes the backup, whether it has been compressed yet or not.'''
+
+        for ext in ('', ) + self.EXTENSIONS:
+            try:
+                os.unlink(filename + ext)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            else:
+                self.log.debug('Removed {0}'.format(filename + ext))
+
+    def get_dir(self, dirname):
+        '''Returns the index of the directory, listing it on first use.'''
+
+        index = self.dirs.get(dirname)
+        if index is None:
+            index = self.dirs[dirname] = self.scan(dirname)
+
+        return index
+
+    def scan(self, dirname):
+        '''Lists the backups found in the directory.'''
+
+        found = {}
+
+        try:
+            filenames = os.listdir(dirname)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return found
+            raise
+
+        for filename in filenames:
+            stem, ext = os.path.splitext(filename)
+            if ext not in self.EXTENSIONS:
+                stem = filename
+
+            for _, regex in self.patterns:
+                match = regex.match(stem)
+                if match:
+                    found.setdefault(match.group(1), set()).add(stem)
+                    break
+
+        return dict((name, sorted(backups)) for name, backups in found.items())
+
+class BackupManager(object):
+    '''Takes care of the backups of log files once they have been rotated.
+
+    Rotating a file only swaps it for a new one. Closing the old file,
+    recording the backup in the BackupIndex, removing old backups and
+    requesting compression are done here, by a thread of its own once
+    start() is called, so that rotating many files at once does not hold up
+    writing. Until then, or if the thread is never started, the work is done
+    right away. Work is done in the order it was requested.
+    '''
+
+    def __init__(self, compressor, index=None):
+        '''Initializes the BackupManager. No thread is started until start() is called.'''
+
+        self.log = logging.getLogger('backups') # internal logger
+
+        self.compressor = compressor
+        self.index = index if index is not None else BackupIndex()
+
+        self.queue = Queue()
+        self.thread = None
+
+        # Backlog stats, reset by get_stats()
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.max_delay = 0.0
+
+    def start(self):
+        '''Starts the thread.'''
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def shutdown(self):
+        '''Processes everything that is queued and stops the thread.'''
+
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def add_pattern(self, pattern):
+        '''Makes the index recognize backups named with the strftime pattern.'''
+
+        self.index.add_pattern(pattern)
+
+    def add(self, filename, backup, backup_count, current=None):
+        '''Handles a backup of the log file filename, keeping backup_count backups.
+
+        All names are full paths, without any compression extension. current
+        is passed on to BackupIndex.remove_old().'''
+
+        self.submit(self.process, filename, backup, backup_count, current, time.time())
+
+    def close(self, closing):
+        '''Calls closing, which closes a file swapped out by rotation, before any backup added later.'''
+
+        self.submit(closing)
+
+    def submit(self, func, *args):
+        '''Queues func(*args) for the thread, or calls it right away if the thread is not running.'''
+
+        if self.thread:
+            self.queue.put((func, args))
+        else:
+            func(*args)
+
+    def run(self):
+        '''Main loop of the thread.'''
+
+        while True:
+            job = self.queue.get()
+
+            # None means "shut down now"
+            if job is None:
+                break
+
+            func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                self.log.error('An error occured handling a backup')
+                self.log.exception(e)
+
+    def process(self, filename, backup, backup_count, current, queued_at):
+        '''Records the backup, removes old backups and requests compression.'''
+
+        self.index.add(filename, backup)
+        self.index.remove_old(filename, backup_count, current)
+
+        self.compressor.compress(backup)
+
+        with self.lock:
+            self.processed += 1
+            self.max_delay = max(self.max_delay, time.time() - queued_at)
+
+    def backlog(self):
+        '''Returns the number of backups waiting to be handled.'''
+
+        return self.queue.qsize()
+
+    def get_stats(self):
+        '''Returns (backlog, backups handled, longest wait in seconds) and resets the last two.'''
+
+        with self.lock:
+            processed, max_delay = self.processed, self.max_delay
+            self.processed, self.max_delay = 0, 0.0
+
+        return self.backlog(), processed, max_delay
@@ -17,6 +17,7 @@ STREAM_COMPRESSOR = 'gzip'
 define_opt('compressor', 'format', default='xz')
 define_opt('compressor', 'level', type=int, default=6)
 define_opt('compressor', 'compress_on_write', type=bool)
+define_opt('compressor', 'max_size_mode', default='compressed')
 
 class CompressorStartupError(Exception):
     '''Raised by Compressor instances if a misconfigruation is detected.'''
@@ -39,7 +40,9 @@ class Compressor(object):
         'xz': '.xz',
     }
 
-    def __init__(self, compress_cmd=None, level=None):
+    MAX_SIZE_MODES = ('compressed', 'uncompressed')
+
+    def __init__(self, compress_cmd=None, level=None, max_size_mode=None):
         '''Initializes the Compressor instance.'''
 
         self.queue = Queue()
@@ -59,6 +62,10 @@ class Compressor(object):
         if not (0 <= self.compress_level <= 9):
             raise CompressorStartupError('The compression level must be between 0 and 9 incluse. It is set to {0}.'.format(self.compress_level))
 
+        self.max_size_mode = max_size_mode or options.compressor.max_size_mode
+        if self.max_size_mode not in self.MAX_SIZE_MODES:
+            raise CompressorStartupError('{0} is not a valid max_size_mode. Valid options are: {1}.'.format(self.max_size_mode, ', '.join(self.MAX_SIZE_MODES)))
+
         if options.compressor.compress_on_write:
             # Note: this command will not actually be used. Instead
             # we will wrap the file object in the compressor of the appropriate type
@@ -143,8 +150,15 @@ class Compressor(object):
         not fully compressed on shutdown.'''
         
         for root, dirs, files in os.walk(path):
+            files = [os.path.join(root, filename) for filename in files]
+
+            # Symlinks point to files that are being written to, see LogFile.open_bucket()
+            active = set(os.path.realpath(filename) for filename in files if os.path.islink(filename))
+
             for filename in files:
-                filename = os.path.join(root, filename)
+                if os.path.islink(filename) or os.path.realpath(filename) in active:
+                    continue
+
                 _, ext = os.path.splitext(filename)
                 if ext in self.COMPRESS_EXTS.values():
                     continue
@@ -199,6 +213,11 @@ class Compressor(object):
 
         return f
 
+    def counts_uncompressed_size(self):
+        '''Returns True if max_size applies to the data before compress_on_write compresses it.'''
+
+        return bool(options.compressor.compress_on_write) and self.max_size_mode == 'uncompressed'
+
     def wrap_filename(self, filename):
         '''If compress_on_write is enabled, return a filename + .gz extension.
         
@@ -0,0 +1,43 @@
+import importlib
+
+class DecoderError(Exception):
+    '''Raised when a JSON decoder cannot be created.'''
+
+# In order of preference. Each entry is (name, module name).
+DECODERS = (
+    ('ujson', 'ujson'),
+    ('simplejson', 'simplejson'),
+    ('json', 'json'),
+)
+
+def available_decoders():
+    '''Returns a list of (name, loads) tuples for all the installed JSON libraries.'''
+
+    result = []
+    for name, module_name in DECODERS:
+        try:
+            module = importlib.import_module(module_name)
+        except ImportError:
+            continue
+
+        result.append((name, module.loads))
+
+    return result
+
+def create_decoder(name='auto'):
+    '''Returns a (name, loads) tuple for the requested JSON library.
+
+    loads takes a bytestring and returns the decoded object, raising
+    ValueError on invalid input. If name is "auto", the fastest library
+    installed is used: ujson, then simplejson, then the standard json module.
+    '''
+
+    valid_names = [d[0] for d in DECODERS]
+    if name != 'auto' and name not in valid_names:
+        raise DecoderError('"{0}" is not a valid JSON decoder. Valid options are: auto, {1}.'.format(name, ', '.join(valid_names)))
+
+    for decoder_name, loads in available_decoders():
+        if name in ('auto', decoder_name):
+            return decoder_name, loads
+
+    raise DecoderError('JSON decoder "{0}" is not installed.'.format(name))
@@ -1,6 +1,6 @@
 from ext.croniter import croniter
 from ConfigParser import RawConfigParser
-import os.path
+import os.path, hashlib, hmac, time
 
 def parse_mod_id(mod_str):
     '''Parses a module string to a mod_id tuple.
@@ -48,8 +48,16 @@ class Facility(object):
         'annually': '0 0 1 1 *',
     }
 
+    # When to make sure written data has reached the disk, see README.md
+    DURABILITY_MODES = ('none', 'interval', 'batch', 'every')
 
-    def __init__(self, app_id, mod_id, rotate, backup_count, max_size=None, secret=None, flush_every=1, file_per_host=False):
+    # Digest algorithms available for HMAC message signatures
+    DIGESTS = {
+        'md5': hashlib.md5,
+        'sha256': hashlib.sha256,
+    }
+
+    def __init__(self, app_id, mod_id, rotate, backup_count, max_size=None, secret=None, flush_every=1, file_per_host=False, digest='md5', flush_interval=None, buffer_bytes=None, durability='none', bucket=None, preallocate=False):
         '''Initializes a facility instance and validtes the input.'''
 
         self.app_id = app_id
@@ -80,11 +88,43 @@ class Facility(object):
         if flush_every and (not isinstance(flush_every, int) or flush_every <= 0): 
             raise FacilityError('Error parsing facility for {0}:{1}: if specified, flush_every must be a positive integer'.format(app_id, self.mod_str))
 
+        if flush_interval and (not isinstance(flush_interval, (int, float)) or flush_interval <= 0):
+            raise FacilityError('Error parsing facility for {0}:{1}: if specified, flush_interval must be a positive number'.format(app_id, self.mod_str))
+
+        if buffer_bytes and (not isinstance(buffer_bytes, int) or buffer_bytes <= 0):
+            raise FacilityError('Error parsing facility for {0}:{1}: if specified, buffer_bytes must be a positive integer'.format(app_id, self.mod_str))
+
+        if preallocate and not max_size:
+            raise FacilityError('Error parsing facility for {0}:{1}: preallocate requires max_size'.format(app_id, self.mod_str))
+
+        if bucket is not None:
+            if rotate == 'size':
+                raise FacilityError('Error parsing facility for {0}:{1}: bucket cannot be used with rotation mode "size"'.format(app_id, self.mod_str))
+
+            if '%' not in bucket or os.sep in time.strftime(bucket):
+                raise FacilityError('Error parsing facility for {0}:{1}: bucket must be a strftime pattern, such as %Y-%m-%d, and cannot contain {2}'.format(app_id, self.mod_str, os.sep))
+
+        if durability not in self.DURABILITY_MODES:
+            raise FacilityError('Error parsing facility for {0}:{1}: "{2}" is not a valid durability. Valid options are: {3}'.format(app_id, self.mod_str, durability, ', '.join(self.DURABILITY_MODES)))
+
+        if digest not in self.DIGESTS:
+            raise FacilityError('Error parsing facility for {0}:{1}: "{2}" is not a valid digest. Valid options are: {3}'.format(app_id, self.mod_str, digest, ', '.join(sorted(self.DIGESTS))))
+
         self.rotate = rotate
         self.backup_count = int(backup_count)
         self.secret = secret
+        self.digest = digest
+
+        # Keying HMAC hashes the secret and both pads, so it is done once per
+        # facility and the result copied for each message, see Processor.verify_signature()
+        self.keyed_hmac = hmac.new(secret, digestmod=self.DIGESTS[digest]) if secret else None
         self.max_size = max_size
         self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer_bytes = buffer_bytes
+        self.durability = durability
+        self.bucket = bucket
+        self.preallocate = preallocate
         self.file_per_host = file_per_host
 
     def __repr__(self):
@@ -96,20 +136,34 @@ class FacilityDB(object):
     Typically a single instance of this class is used as a registry of the facilities.
     It provides a way to look up a facility for a given app_id and module string
     via the get_facility() method.
+
+    Lookups are memoized, including the ones that find nothing. The facilities and
+    the memo are kept in a single tuple, so that a reload swaps them atomically
+    and a concurrent lookup never caches a result from the old configuration.
     '''
 
-    def __init__(self):
+    CACHE_SIZE = 10000 # Max number of memoized lookups. The memo is emptied when full.
+
+    def __init__(self, cache_size=None):
         '''Initializes an empty FacilityDB.'''
 
-        self.facilities = {}
+        self.cache_size = cache_size or self.CACHE_SIZE
+        self.state = ({}, {}) # (app_id -> mod_id -> Facility, memoized lookups)
+
+    @property
+    def facilities(self):
+        return self.state[0]
 
     def add_facility(self, facility):
         '''Registers a facility with the database.'''
 
-        if facility.app_id not in self.facilities:
-            self.facilities[facility.app_id] = {}
+        facilities, cache = self.state
+
+        if facility.app_id not in facilities:
+            facilities[facility.app_id] = {}
 
-        self.facilities[facility.app_id][facility.mod_id] = facility
+        facilities[facility.app_id][facility.mod_id] = facility
+        cache.clear()
 
     def get_applications(self):
         '''Enumerates all application IDs.'''
@@ -137,21 +191,42 @@ class FacilityDB(object):
         then root.foo will be returned. If we have the same facilities defined and
         mod_str is 'bam.tee', then root will be returned.
 
-        returns a Facility instance.
+        mod_str may also be a mod_id tuple.
+
+        returns a Facility instance, or None if app is unknown.
         '''
 
+        facilities, cache = self.state
+
+        key = (app, mod_str)
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+
+        facility = self.find_facility(facilities, app, mod_str)
+
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[key] = facility
+
+        return facility
+
+    def find_facility(self, facilities, app, mod_str):
+        '''Does the actual search for get_facility() without using the memo.'''
+
         if isinstance(mod_str, basestring):
             mod_id = parse_mod_id(mod_str)
         else:
             mod_id = mod_str
 
-        app_facilities = self.facilities.get(app, None)
+        app_facilities = facilities.get(app, None)
 
         if not app_facilities:
             return None
 
         while mod_id:
-            if mod_id in app_facilities.keys():
+            if mod_id in app_facilities:
                 return app_facilities[mod_id]
             mod_id = mod_id[:-1]
  
@@ -196,7 +271,7 @@ class FacilityDB(object):
             facility = self.parse_section(cp, section, root_facility=root_facility)
             db.add_facility(facility)
 
-        self.facilities = db.facilities
+        self.state = (db.facilities, {})
         self.filename = filename
 
     def parse_section(self, cp, section, root_facility=None):
@@ -210,24 +285,40 @@ class FacilityDB(object):
         settings['mod_id'] = parse_mod_id(mod_str)
         settings['rotate'] = cp.get(section, 'rotate')
         settings['backup_count'] = cp.getint(section, 'backup_count')
+        settings['bucket'] = cp.get(section, 'bucket') if cp.has_option(section, 'bucket') else None
         
         # Figure out values of inherited params
         def_secret = None
+        def_digest = 'md5'
         def_max_size = None
         def_file_per_host = False
         def_flush_every = 1
+        def_flush_interval = None
+        def_buffer_bytes = None
+        def_durability = 'none'
+        def_preallocate = False
 
         if root_facility:
             def_secret = root_facility.secret
+            def_digest = root_facility.digest
             def_max_size = root_facility.max_size
             def_file_per_host = root_facility.file_per_host
             def_flush_every = root_facility.flush_every
+            def_flush_interval = root_facility.flush_interval
+            def_buffer_bytes = root_facility.buffer_bytes
+            def_durability = root_facility.durability
+            def_preallocate = root_facility.preallocate
 
         # These options can be inherited
         settings['secret'] = cp.get(section, 'secret') if cp.has_option(section, 'secret') else def_secret
+        settings['digest'] = cp.get(section, 'digest') if cp.has_option(section, 'digest') else def_digest
         settings['max_size'] = cp.getint(section, 'max_size') if cp.has_option(section, 'max_size') else def_max_size
         settings['file_per_host'] = cp.getboolean(section, 'file_per_host') if cp.has_option(section, 'file_per_host') else def_file_per_host
         settings['flush_every'] = cp.getint(section, 'flush_every') if cp.has_option(section, 'flush_every') else def_flush_every
+        settings['flush_interval'] = cp.getfloat(section, 'flush_interval') if cp.has_option(section, 'flush_interval') else def_flush_interval
+        settings['buffer_bytes'] = cp.getint(section, 'buffer_bytes') if cp.has_option(section, 'buffer_bytes') else def_buffer_bytes
+        settings['durability'] = cp.get(section, 'durability') if cp.has_option(section, 'durability') else def_durability
+        settings['preallocate'] = cp.getboolean(section, 'preallocate') if cp.has_option(section, 'preallocate') else def_preallocate
 
         return Facility(**settings)
 
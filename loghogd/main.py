@@ -6,11 +6,13 @@ try:
 except ImportError:
     import ConfigParser as configparser
 
-from server import Server
+from server import Server, open_unix_listeners, close_unix_listeners
 from writer import Writer
 from processor import Processor
+from pipeline import Pipeline
 from facilities import FacilityDB, FacilityError
 from compressor import Compressor
+from workers import WorkerPool
 from daemon import daemonize, write_pid, drop_privileges
 from util import normalize_path, get_file_md5
 
@@ -25,6 +27,7 @@ define_opt('main', 'facilities_config', cmd_name='facilities-config', cmd_short_
 define_opt('main', 'pidfile', cmd_name='pid', cmd_short_name='p', default='loghogd.pid')
 define_opt('main', 'daemon', type=bool, cmd_name='daemon', cmd_short_name='d')
 define_opt('main', 'user', cmd_name='user', default=None)
+define_opt('main', 'stats_interval', type=int, default=300)
 
 define_opt('main', 'logdir', cmd_name='log-dir', cmd_short_name='L', default='/var/log/loghogd')
 define_opt('main', 'workdir', cmd_name='work-dir', default='/var/lib/loghogd')
@@ -37,16 +40,26 @@ define_opt('log', 'level', default='INFO')
 
 cached_config_md5 = None
 
-def shutdown(signum, server, writer, compressor):
-    '''Gracefully shuts down LogHog.'''
+def request_shutdown(signum, server):
+    '''Asks the main loop to exit. The actual shutdown happens in shutdown().'''
 
-    if signum:
-        logging.getLogger().info('Recevied signal {}. Shutting down.'.format(signum))
+    logging.getLogger().info('Recevied signal {}. Shutting down.'.format(signum))
     server.shutdown()
+
+def shutdown(writer, compressor, pipeline=None, unix_listeners=None):
+    '''Gracefully shuts down LogHog once the main loop has exited.'''
+
+    # Finish processing messages that were already received
+    if pipeline:
+        pipeline.close()
+
     writer.close()
     compressor.shutdown()
 
-def reload_config(signum, facility_db, writer):
+    if unix_listeners:
+        close_unix_listeners(unix_listeners)
+
+def reload_config(signum, facility_db, writer, pool=None):
     '''Reloads process configuration if possible.'''
 
     logger = logging.getLogger()
@@ -60,11 +73,53 @@ def reload_config(signum, facility_db, writer):
 
     facility_db.reload()
     writer.reload()
+
+    if pool:
+        pool.reload()
+
     logger.info('Reload complete.')
 
 # These simply change the function signature, creating necessary closures
-make_shutdown_handler = lambda server, writer, compressor: lambda signum, frame: shutdown(signum, server, writer, compressor)
-make_reload_handler = lambda facility_db, writer: lambda signum, frame: reload_config(signum, facility_db, writer)
+make_shutdown_handler = lambda server: lambda signum, frame: request_shutdown(signum, server)
+make_reload_handler = lambda facility_db, writer, pool=None: lambda signum, frame: reload_config(signum, facility_db, writer, pool)
+
+def create_server(facility_db, writer, conf_root, **kwargs):
+    '''Creates the Server and, if enabled, the processing Pipeline. Returns (server, pipeline).'''
+
+    processor = Processor(facility_db, writer)
+    logging.getLogger().debug('Using the {0} JSON decoder.'.format(processor.json_decoder))
+
+    if not options.pipeline.queue_size:
+        return Server(processor.on_messages, conf_root, **kwargs), None
+
+    pipeline = Pipeline(processor.on_messages)
+    server = Server(pipeline.submit_stream, conf_root, dgram_callback=pipeline.submit_dgram, **kwargs)
+
+    if options.main.stats_interval:
+        server.add_timer(options.main.stats_interval, pipeline.log_stats)
+
+    return server, pipeline
+
+def make_worker(facility_db, conf_root, unix_listeners):
+    '''Returns the function that runs the main loop of an ingest worker process.'''
+
+    def run_worker(remote_writer):
+        server, pipeline = create_server(facility_db, remote_writer, conf_root, reuse_port=True, unix_listeners=unix_listeners)
+
+        signal.signal(signal.SIGINT, lambda signum, frame: server.shutdown())
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.shutdown())
+        signal.signal(signal.SIGHUP, lambda signum, frame: facility_db.reload())
+
+        if pipeline:
+            pipeline.start()
+
+        try:
+            server.run()
+        finally:
+            if pipeline:
+                pipeline.close()
+
+    return run_worker
 
 def exit_handler():
     '''Cleanup routine. This function runs right before loghogd is about to exit.'''
@@ -185,16 +240,30 @@ def main():
         compressor.find_uncompressed(options.main.logdir, r'.+\.log\..+')
 
         writer = Writer(facility_db, compressor, options.main.logdir)
-        processor = Processor(facility_db, writer)
 
-        server = Server(processor.on_message, conf_root)
+        if options.server.workers:
+            # UNIX sockets cannot be bound by each worker, so they are shared instead
+            unix_listeners = open_unix_listeners(conf_root)
 
-        signal_handler = make_shutdown_handler(server, writer, compressor)
+            # Fork before any threads are started. The parent becomes the writer.
+            server = pool = WorkerPool(options.server.workers, facility_db, writer, make_worker(facility_db, conf_root, unix_listeners))
+            pool.start()
+            pipeline = None
+        else:
+            server, pipeline = create_server(facility_db, writer, conf_root)
+            pool = unix_listeners = None
+
+        # Both Server and WorkerPool run the writer's timers in their main loop
+        server.add_timer(Writer.TICK_INTERVAL, writer.tick)
+        if options.main.stats_interval:
+            server.add_timer(options.main.stats_interval, writer.log_stats)
+
+        signal_handler = make_shutdown_handler(server)
 
         signal.signal(signal.SIGINT, signal_handler)
         signal.signal(signal.SIGTERM, signal_handler)
         
-        signal.signal(signal.SIGHUP, make_reload_handler(facility_db, writer))
+        signal.signal(signal.SIGHUP, make_reload_handler(facility_db, writer, pool))
     except Exception as e:
         logging.getLogger().error(e)
         logging.getLogger().error('Exiting abnormally due to an error at startup.')
@@ -202,13 +271,24 @@ def main():
 
     try:
         compressor.start()
+        writer.start()
+        if pipeline:
+            pipeline.start()
         server.run()
     except Exception as e:
         logging.getLogger().exception(e)
         logging.getLogger().error('Exiting abnormally due to an error at runtime.')
-        shutdown(None, server, writer, compressor)
+        if pool:
+            pool.shutdown()
+        shutdown(writer, compressor, pipeline, unix_listeners)
+        sys.exit(os.EX_SOFTWARE)
+
+    shutdown(writer, compressor, pipeline, unix_listeners)
+
+    if pool and pool.failed:
+        logging.getLogger().error('Exiting abnormally because an ingest worker died.')
         sys.exit(os.EX_SOFTWARE)
-    
+
     logging.getLogger().info('Shutdown complete. Exiting.')
 
 if __name__ == '__main__':
@@ -0,0 +1,162 @@
+from __future__ import with_statement
+import threading, logging
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
+from ext.groper import define_opt, options
+
+define_opt('pipeline', 'queue_size', type=int, default=0)
+define_opt('pipeline', 'threads', type=int, default=1)
+define_opt('pipeline', 'stream_overflow', default='block')
+define_opt('pipeline', 'dgram_overflow', default='drop')
+
+class PipelineStartupError(Exception):
+    '''Raised by Pipeline instances if a misconfiguration is detected.'''
+
+class Pipeline(object):
+    '''Decouples the network loop from message processing.
+
+    The Server hands batches of framed messages to submit_stream() and
+    submit_dgram(), which put them on a bounded queue. Each processing
+    thread has a queue of its own, takes the batches off it and passes them
+    to the callback. All the batches from one peer address go to the same
+    thread, so that the messages of a connection are processed in order.
+
+    When a queue is full, a batch is either refused ("block") or discarded
+    ("drop"), depending on where it came from. A refused batch is kept by
+    the Server, which stops reading from that socket and submits the batch
+    again later, so the network loop itself never waits.
+    '''
+
+    OVERFLOW_POLICIES = ('block', 'drop')
+
+    def __init__(self, callback, queue_size=None, threads=None, stream_overflow=None, dgram_overflow=None):
+        '''Initializes the Pipeline instance.
+
+        param callback : callable
+            Called as callback(batch) from the processing threads
+        param queue_size : int
+            Maximum number of batches waiting to be processed, per thread
+        param threads : int
+            Number of processing threads
+        param stream_overflow : basestring
+            What to do with batches read from stream sockets when the queue is full: block or drop
+        param dgram_overflow : basestring
+            What to do with batches read from datagram sockets when the queue is full: block or drop
+        '''
+
+        self.log = logging.getLogger('pipeline') # internal logger
+
+        self.callback = callback
+
+        self.queue_size = queue_size if queue_size is not None else options.pipeline.queue_size
+        self.num_threads = threads if threads is not None else options.pipeline.threads
+        self.stream_overflow = stream_overflow if stream_overflow is not None else options.pipeline.stream_overflow
+        self.dgram_overflow = dgram_overflow if dgram_overflow is not None else options.pipeline.dgram_overflow
+
+        if self.queue_size <= 0:
+            raise PipelineStartupError('pipeline.queue_size must be a positive integer.')
+
+        if self.num_threads <= 0:
+            raise PipelineStartupError('pipeline.threads must be a positive integer.')
+
+        for policy in (self.stream_overflow, self.dgram_overflow):
+            if policy not in self.OVERFLOW_POLICIES:
+                raise PipelineStartupError('{0} is not a valid overflow policy. Valid options are: {1}.'.format(policy, ', '.join(self.OVERFLOW_POLICIES)))
+
+        self.queues = [Queue(self.queue_size) for _ in xrange(self.num_threads)]
+        self.threads = []
+
+        self.stats_lock = threading.Lock()
+        self.high_water = 0 # Deepest a queue got since the last log_stats()
+        self.dropped = 0 # Messages dropped since the last log_stats()
+
+    def start(self):
+        '''Starts the processing threads.'''
+
+        for queue in self.queues:
+            t = threading.Thread(target=self.run, args=(queue, ))
+            t.start()
+            self.threads.append(t)
+
+    def submit_stream(self, batch):
+        '''Queues a batch of messages read from a stream socket. Returns False if it was refused.'''
+
+        return self.submit(batch, self.stream_overflow)
+
+    def submit_dgram(self, batch):
+        '''Queues a batch of messages read from a datagram socket. Returns False if it was refused.'''
+
+        return self.submit(batch, self.dgram_overflow)
+
+    def get_queue(self, batch):
+        '''Returns the queue of the thread that processes messages from the peer the batch came from.'''
+
+        _, addr = batch[0]
+        return self.queues[hash(addr) % len(self.queues)]
+
+    def submit(self, batch, overflow):
+        '''Queues a batch of messages, applying the overflow policy if the queue is full.
+
+        Returns False if the batch was refused, so that it can be submitted
+        again later, and True if it was queued or dropped.'''
+
+        queue = self.get_queue(batch)
+
+        try:
+            queue.put_nowait(batch)
+        except Full:
+            if overflow == 'block':
+                return False
+
+            with self.stats_lock:
+                self.dropped += len(batch)
+            return True
+
+        depth = queue.qsize()
+        if depth > self.high_water:
+            with self.stats_lock:
+                self.high_water = max(self.high_water, depth)
+
+        return True
+
+    def run(self, queue):
+        '''Main loop for the processing threads.'''
+
+        while True:
+            batch = queue.get()
+
+            # None means "shut down now"
+            if batch is None:
+                break
+
+            try:
+                self.callback(batch)
+            except Exception as e:
+                self.log.exception(e)
+
+    def log_stats(self):
+        '''Logs the queue high-water mark and the number of dropped messages, then resets them.'''
+
+        with self.stats_lock:
+            high_water, dropped = self.high_water, self.dropped
+            self.high_water, self.dropped = max(queue.qsize() for queue in self.queues), 0
+
+        self.log.info('Queue high-water mark: {0} of {1} batches. Messages dropped: {2}.'.format(high_water, self.queue_size, dropped))
+
+        if high_water >= self.queue_size:
+            self.log.warning('A processing queue was full. Consider raising pipeline.queue_size or pipeline.threads.')
+
+    def close(self):
+        '''Processes everything still on the queues, then stops the processing threads.'''
+
+        for queue in self.queues[:len(self.threads)]:
+            queue.put(None)
+
+        for t in self.threads:
+            t.join()
+
+        self.threads = []
+        self.log_stats()
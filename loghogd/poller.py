@@ -0,0 +1,197 @@
+'''I/O readiness notification backends for the main loop.
+
+A poller keeps a persistent set of registered file descriptors, so the
+caller does not have to pass in the full list of sockets on every
+iteration of the event loop. All backends are level-triggered and have
+the same methods:
+
+register(fd, events=POLL_READ) starts watching fd for the given events.
+modify(fd, events) changes the set of events that fd is watched for.
+unregister(fd) stops watching fd. Unknown descriptors are ignored.
+poll(timeout=None) waits for events and returns a list of (fd, events)
+    tuples. timeout is in seconds; None means wait forever. If the wait
+    is interrupted by a signal, an empty list is returned.
+close() releases resources held by the poller.
+
+Use create_poller() to get the best backend available.
+'''
+
+import select, errno
+
+POLL_READ = 0x01
+POLL_WRITE = 0x02
+
+class PollerError(Exception):
+    '''Raised when a poller backend cannot be created.'''
+
+class EpollPoller(object):
+    '''Linux epoll(7) backend.'''
+
+    name = 'epoll'
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def to_native(self, events):
+        native = 0
+        if events & POLL_READ:
+            native |= select.EPOLLIN
+        if events & POLL_WRITE:
+            native |= select.EPOLLOUT
+        return native
+
+    def register(self, fd, events=POLL_READ):
+        self.epoll.register(fd, self.to_native(events))
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, self.to_native(events))
+
+    def unregister(self, fd):
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    def poll(self, timeout=None):
+        try:
+            native_events = self.epoll.poll(-1 if timeout is None else timeout)
+        except (IOError, OSError) as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+
+        result = []
+        for fd, native in native_events:
+            events = 0
+            # Errors and hangups are reported as readable so that the
+            # subsequent read discovers the condition and cleans up.
+            if native & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                events |= POLL_READ
+            if native & select.EPOLLOUT:
+                events |= POLL_WRITE
+            result.append((fd, events))
+
+        return result
+
+    def close(self):
+        self.epoll.close()
+
+class PollPoller(object):
+    '''poll(2) backend.'''
+
+    name = 'poll'
+
+    def __init__(self):
+        self.poller = select.poll()
+
+    def to_native(self, events):
+        native = 0
+        if events & POLL_READ:
+            native |= select.POLLIN
+        if events & POLL_WRITE:
+            native |= select.POLLOUT
+        return native
+
+    def register(self, fd, events=POLL_READ):
+        self.poller.register(fd, self.to_native(events))
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, self.to_native(events))
+
+    def unregister(self, fd):
+        try:
+            self.poller.unregister(fd)
+        except KeyError:
+            pass
+
+    def poll(self, timeout=None):
+        try:
+            native_events = self.poller.poll(None if timeout is None else timeout * 1000)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        result = []
+        for fd, native in native_events:
+            events = 0
+            if native & (select.POLLIN | select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                events |= POLL_READ
+            if native & select.POLLOUT:
+                events |= POLL_WRITE
+            result.append((fd, events))
+
+        return result
+
+    def close(self):
+        pass
+
+class SelectPoller(object):
+    '''select(2) backend. Limited to FD_SETSIZE descriptors; use only as a last resort.'''
+
+    name = 'select'
+
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events=POLL_READ):
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+
+        if events & POLL_READ:
+            self.readers.add(fd)
+        if events & POLL_WRITE:
+            self.writers.add(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout=None):
+        try:
+            r, w, x = select.select(self.readers, self.writers, self.readers, timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+        events = {}
+        for fd in r:
+            events[fd] = events.get(fd, 0) | POLL_READ
+        for fd in x:
+            events[fd] = events.get(fd, 0) | POLL_READ
+        for fd in w:
+            events[fd] = events.get(fd, 0) | POLL_WRITE
+
+        return events.items()
+
+    def close(self):
+        pass
+
+POLLERS = (
+    ('epoll', EpollPoller, lambda: hasattr(select, 'epoll')),
+    ('poll', PollPoller, lambda: hasattr(select, 'poll')),
+    ('select', SelectPoller, lambda: True),
+)
+
+def create_poller(name='auto'):
+    '''Returns a new poller instance.
+
+    If name is "auto", the most scalable backend available on this platform
+    is used: epoll, then poll, then select.
+    '''
+
+    for poller_name, cls, is_available in POLLERS:
+        if name not in ('auto', poller_name):
+            continue
+
+        if is_available():
+            return cls()
+
+        if name != 'auto':
+            raise PollerError('Poller "{0}" is not available on this platform.'.format(name))
+
+    raise PollerError('"{0}" is not a valid poller. Valid options are: auto, {1}.'.format(name, ', '.join(p[0] for p in POLLERS)))
@@ -1,10 +1,27 @@
 
 import hmac, hashlib, logging
+from ext.groper import define_opt, options
 from util import pretty_addr
+from decoder import create_decoder
+from facilities import Facility
+
+define_opt('processor', 'json_decoder', default='auto')
+
 try:
-    import json
-except ImportError:
-    import simplejson as json
+    compare_digest = hmac.compare_digest
+except AttributeError:
+    # Python < 2.7.7
+    def compare_digest(a, b):
+        '''Compares two bytestrings in constant time.'''
+
+        if len(a) != len(b):
+            return False
+
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+
+        return result == 0
 
 class LogParseError(Exception):
     '''Error raised when a message payload cannot be parsed.'''
@@ -21,14 +38,18 @@ class Processor(object):
 
     HMAC_DIGEST_ALGO = hashlib.md5
 
-    def __init__(self, facility_db, writer):
-        '''Initializes the Processor instance with the given facility_db and writer instances.'''
+    def __init__(self, facility_db, writer, json_decoder=None):
+        '''Initializes the Processor instance with the given facility_db and writer instances.
+
+        json_decoder names the JSON library used to decode payloads, see decoder.create_decoder().'''
 
         self.facility_db = facility_db
         self.writer = writer
 
         self.log = logging.getLogger()
 
+        self.json_decoder, self.json_loads = create_decoder(json_decoder or options.processor.json_decoder)
+
     def validate_msg(self, msg):
         '''Validates that the given message has all the required fields.'''
 
@@ -36,26 +57,42 @@ class Processor(object):
             if field not in msg:
                 raise LogParseError('Invalid message: "%s" is not in the message' % field, msg)
 
-    def verify_signature(self, secret, msg):
+    def verify_signature(self, secret, msg, digest=None, keyed_hmac=None):
         '''Validates message signature agains the shared secret.
 
-        secret must be a string or None.'''
+        secret must be a string or None. digest is the name of the digest
+        algorithm, see Facility.DIGESTS. HMAC_DIGEST_ALGO is used by default.
+        keyed_hmac is an HMAC object already keyed with secret and digest, such
+        as Facility.keyed_hmac. It is copied, never updated. Without it the
+        HMAC is keyed for this call only.'''
 
         if secret:
             if 'signature' not in msg:
                 raise LogParseError('Security alert: message signature is required but not present', msg)
 
-            hashable = u''.join(unicode(msg[field]) for field in self.HASHABLE_FIELDS).encode('utf-8')
-            signature = hmac.new(secret, hashable, self.HMAC_DIGEST_ALGO).hexdigest()
+            signature = msg['signature']
+            if isinstance(signature, unicode):
+                signature = signature.encode('utf-8')
+            elif not isinstance(signature, str):
+                raise LogParseError('Security alert: message signature is not a string', msg)
+
+            if keyed_hmac is None:
+                keyed_hmac = hmac.new(secret, digestmod=Facility.DIGESTS[digest] if digest else self.HMAC_DIGEST_ALGO)
 
-            if signature != msg['signature']:
+            # Same fields as HASHABLE_FIELDS, spelled out to avoid a generator per message
+            hashable = u'%s%s%s%s%s' % (msg['app_id'], msg['module'], msg['stamp'], msg['nsecs'], msg['body'])
+
+            h = keyed_hmac.copy()
+            h.update(hashable.encode('utf-8'))
+
+            if not compare_digest(h.hexdigest(), signature):
                 raise LogParseError('Security alert: message signature is invalid', msg)
 
     def parse_message(self, data):
         '''Parses the message payload into a validated dict() instance.'''
 
         try:
-            msg = json.loads(data)
+            msg = self.json_loads(data)
         except ValueError as e:
             raise LogParseError('Message payload is not valid JSON: %s' % e, data)
 
@@ -63,8 +100,25 @@ class Processor(object):
 
         return msg
 
-    def on_message(self, msg_bytes, addr):
-        '''Callback method called by Server when new messages arrive.'''
+    def on_messages(self, batch):
+        '''Callback method called by Server with a list of (msg_bytes, addr) tuples.
+
+        All the valid messages in the batch are handed to the writer in a single call.'''
+
+        records = []
+        for msg_bytes, addr in batch:
+            record = self.prepare_message(msg_bytes, addr)
+            if record:
+                records.append(record)
+
+        if records:
+            self.writer.write_many(records)
+
+    def prepare_message(self, msg_bytes, addr):
+        '''Parses the message and looks up its facility.
+
+        Returns a (facility, msg) tuple ready for the writer, or None
+        if the message should be discarded.'''
 
         try:
             msg = self.parse_message(msg_bytes)
@@ -72,16 +126,18 @@ class Processor(object):
             facility = self.facility_db.get_facility(msg['app_id'], msg['module'])
             if not facility:
                 self.log.warning("Recevied message for app {0}, but could not find corresponding facility.".format(msg['app_id']))
-                return
+                return None
 
-            try:
-                self.verify_signature(facility.secret, msg)
-            except LogParseError as e:
-                self.log.warning('Signature verification error: {0}'.format(e))
+            if facility.secret:
+                try:
+                    self.verify_signature(facility.secret, msg, facility.digest, facility.keyed_hmac)
+                except LogParseError as e:
+                    self.log.warning('Signature verification error: {0}'.format(e))
 
-            self.log.debug('Got message %r from %r', msg, pretty_addr(addr))
-            self.writer.write(facility.app_id, facility.mod_id, msg)
+            if self.log.isEnabledFor(logging.DEBUG): # Spares pretty_addr() for every message
+                self.log.debug('Got message %r from %r', msg, pretty_addr(addr))
+            return (facility, msg)
         except Exception as e:
             self.log.error('An error occured processing message: {0}'.format(msg_bytes))
             self.log.exception(e)
-
+            return None
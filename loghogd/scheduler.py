@@ -25,11 +25,10 @@ class Scheduler(object):
 
     '''
 
-    def __init__(self, db_filename='schedules'):
+    def __init__(self, db_filename='schedules', workdir=None):
         '''Initializes the scheduler and opens the dbm file.'''
 
-        db_filename = db_filename
-        db_filename = os.path.join(options.main.workdir, db_filename)
+        db_filename = os.path.join(workdir or options.main.workdir, db_filename)
         self.db = dbm.open(db_filename, 'c', 0o600)
 
     def get_next_execution(self, job_id, schedule, now):
@@ -1,7 +1,8 @@
-import socket, select, struct, zlib, ssl, logging, os, time
+import socket, struct, zlib, ssl, logging, os, sys, time, errno, stat, pwd, grp
 from ext.groper import define_opt, options
 
-from util import parse_addrs, format_connection_message, normalize_path
+from util import parse_addrs, parse_unix_addrs, format_connection_message, normalize_path
+from poller import create_poller, POLL_READ, POLL_WRITE
 
 define_opt('server', 'default_port', type=int, default=5566)
 define_opt('server', 'listen_ipv4', default='127.0.0.1')
@@ -13,6 +14,23 @@ define_opt('server', 'listen_ipv6_ssl', default='')
 
 define_opt('server', 'pemfile', default='')
 define_opt('server', 'cacert', default='')
+define_opt('server', 'ssl_handshake_timeout', type=int, default=10)
+
+define_opt('server', 'listen_unix_stream', default='')
+define_opt('server', 'listen_unix_dgram', default='')
+define_opt('server', 'unix_socket_mode', default='0666')
+define_opt('server', 'unix_socket_owner', default='')
+define_opt('server', 'unix_socket_group', default='')
+
+define_opt('server', 'poller', default='auto')
+
+define_opt('server', 'udp_batch_size', type=int, default=64)
+define_opt('server', 'udp_rcvbuf', type=int, default=0)
+
+define_opt('server', 'workers', type=int, default=0)
+
+# Python 2 does not export this constant
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
 
 class ServerError(Exception):
     '''Raised when the server experiences an error.'''
@@ -20,6 +38,180 @@ class ServerError(Exception):
 class ServerStartupError(Exception):
     '''Raised when the server cannot start.'''
 
+def remove_stale_unix_socket(filename, proto):
+    '''Removes a UNIX socket file left behind by a process that is no longer running.
+
+    Raises ServerStartupError if the file is not a socket or if another
+    process is still listening on it.'''
+
+    try:
+        st = os.stat(filename)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return # Nothing to clean up
+        raise
+
+    if not stat.S_ISSOCK(st.st_mode):
+        raise ServerStartupError('{0} already exists and is not a socket.'.format(filename))
+
+    probe = socket.socket(socket.AF_UNIX, proto)
+    try:
+        probe.connect(filename)
+    except socket.error as e:
+        if e.args[0] != errno.ECONNREFUSED:
+            raise ServerStartupError('Cannot use {0}: {1}'.format(filename, e))
+    else:
+        raise ServerStartupError('{0} is in use by another process.'.format(filename))
+    finally:
+        probe.close()
+
+    os.unlink(filename)
+    logging.getLogger('server').info('Removed stale socket {0}.'.format(filename))
+
+def open_unix_listeners(conf_root, listen_unix_stream=None, listen_unix_dgram=None, unix_socket_mode=None, unix_socket_owner=None, unix_socket_group=None, backlog=5):
+    '''Creates, binds and returns the UNIX domain listener sockets.
+
+    This is separate from the Server class so that the sockets can be opened
+    once and shared by several ingest processes, since SO_REUSEPORT does not
+    apply to UNIX domain sockets. Returns a list of (sock, proto, address) tuples.
+    '''
+
+    log = logging.getLogger('server')
+
+    listen_unix_stream = listen_unix_stream if listen_unix_stream is not None else options.server.listen_unix_stream
+    listen_unix_dgram = listen_unix_dgram if listen_unix_dgram is not None else options.server.listen_unix_dgram
+    unix_socket_mode = unix_socket_mode if unix_socket_mode is not None else options.server.unix_socket_mode
+    unix_socket_owner = unix_socket_owner if unix_socket_owner is not None else options.server.unix_socket_owner
+    unix_socket_group = unix_socket_group if unix_socket_group is not None else options.server.unix_socket_group
+
+    try:
+        mode = int(unix_socket_mode, 8)
+    except ValueError:
+        raise ServerStartupError('server.unix_socket_mode must be an octal number, such as 0660.')
+
+    try:
+        uid = pwd.getpwnam(unix_socket_owner).pw_uid if unix_socket_owner else -1
+        gid = grp.getgrnam(unix_socket_group).gr_gid if unix_socket_group else -1
+    except KeyError as e:
+        raise ServerStartupError('Unknown user or group for UNIX sockets: {0}'.format(e))
+
+    listeners = []
+    for addrs_str, proto in ((listen_unix_stream, socket.SOCK_STREAM), (listen_unix_dgram, socket.SOCK_DGRAM)):
+        for address in parse_unix_addrs(addrs_str):
+            address['filename'] = normalize_path(address['filename'], conf_root)
+            filename = address['filename']
+
+            remove_stale_unix_socket(filename, proto)
+
+            sock = socket.socket(socket.AF_UNIX, proto)
+            try:
+                sock.bind(filename)
+                os.chmod(filename, mode)
+                if uid != -1 or gid != -1:
+                    os.chown(filename, uid, gid)
+            except (socket.error, OSError) as e:
+                sock.close()
+                raise ServerStartupError('Cannot listen on {0}: {1}'.format(filename, e))
+
+            if proto == socket.SOCK_STREAM:
+                sock.listen(backlog)
+
+            # The socket may be shared by several processes, so never block on it
+            sock.setblocking(0)
+
+            log.info(format_connection_message(address, socket.AF_UNIX, proto, False))
+            listeners.append((sock, proto, address))
+
+    return listeners
+
+def close_unix_listeners(listeners):
+    '''Closes the sockets returned by open_unix_listeners() and removes their files.'''
+
+    for sock, proto, address in listeners:
+        sock.close()
+
+        try:
+            os.unlink(address['filename'])
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+class StreamBuffer(object):
+    '''A growable receive buffer for a single stream connection.
+
+    Data between start and end has been received but not yet parsed. The
+    parsed prefix is only reclaimed once most of the buffer is consumed, so
+    a burst of small messages does not cause the remainder to be copied
+    after every frame.
+    '''
+
+    def __init__(self, size):
+        self.data = bytearray(size)
+        self.start = 0 # Offset of the first unparsed byte
+        self.end = 0 # Offset right after the last received byte
+
+        self.decompressor = None # Created by the first frame that uses streaming compression
+        self.compressed_bytes = 0
+        self.decompressed_bytes = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, nbytes):
+        '''Makes sure there are at least nbytes of free space at the end of the buffer.'''
+
+        if self.start == self.end:
+            # Everything was consumed. Rewind for free.
+            self.start = self.end = 0
+
+        if len(self.data) - self.end >= nbytes:
+            return
+
+        pending = self.end - self.start
+        if self.start >= pending and len(self.data) - pending >= nbytes:
+            # Mostly consumed: move the unparsed tail to the front
+            self.data[:pending] = self.data[self.start:self.end]
+            self.start, self.end = 0, pending
+        else:
+            self.data.extend(bytearray(max(nbytes, len(self.data))))
+
+    def recv_into(self, sock, nbytes):
+        '''Reads up to nbytes from sock directly into the buffer. Returns the number of bytes read.'''
+
+        self.reserve(nbytes)
+        received = sock.recv_into(memoryview(self.data)[self.end:], nbytes)
+        self.end += received
+
+        return received
+
+    def decompress(self, payload):
+        '''Decompresses a payload using the zlib stream shared by the whole connection.
+
+        The client must end each frame with a sync flush, so that every frame
+        can be decompressed as soon as it arrives. The stream is never ended:
+        data after the end of it is a protocol error, and raises ServerError.'''
+
+        if self.decompressor is None:
+            self.decompressor = zlib.decompressobj()
+
+        data = self.decompressor.decompress(payload)
+
+        if self.decompressor.unused_data:
+            raise ServerError('{0} bytes of data after the end of the compressed stream.'.format(len(self.decompressor.unused_data)))
+
+        self.compressed_bytes += len(payload)
+        self.decompressed_bytes += len(data)
+
+        return data
+
+    def compression_ratio(self):
+        '''Returns the ratio of decompressed to compressed bytes seen so far, or None.'''
+
+        if not self.compressed_bytes:
+            return None
+
+        return float(self.decompressed_bytes) / self.compressed_bytes
+
 class Server(object):
     '''Main server class.
 
@@ -28,24 +220,34 @@ class Server(object):
     '''
     
     SHUTDOWN_TIMEOUT = 0.25 # small timeout between socket.shutdown() and socket.close()
+    RESUME_INTERVAL = 0.05 # How often refused batches are submitted again, in seconds
 
     STREAM_SOCKET_BACKLOG = 5
     MAX_MSG_SIZE = 1024*8
 
     BUFSIZE = 4096
     _FLAGS_GZIP = 0x01
+    _FLAGS_BATCH = 0x02 # Payload holds several messages, each prefixed with BATCH_ITEM_FORMAT
+    _FLAGS_ZLIB_STREAM = 0x04 # Payload is the next chunk of the connection's zlib stream
     
     HEADER_FORMAT = '!LL'
     HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
-    MSG_FORMAT_PROTO = '%ds'
 
-    def __init__(self, callback, conf_root, listen_ipv4=None, listen_ipv6=None, default_port=None, listen_ipv4_ssl=None, listen_ipv6_ssl=None, default_port_ssl=None, pemfile=None, cacert=None):
+    BATCH_ITEM_FORMAT = '!L'
+    BATCH_ITEM_SIZE = struct.calcsize(BATCH_ITEM_FORMAT)
+
+    def __init__(self, callback, conf_root, dgram_callback=None, listen_ipv4=None, listen_ipv6=None, default_port=None, listen_ipv4_ssl=None, listen_ipv6_ssl=None, default_port_ssl=None, pemfile=None, cacert=None, poller=None, udp_batch_size=None, udp_rcvbuf=None, reuse_port=False, ssl_handshake_timeout=None, unix_listeners=None):
         '''Initializes the server and listens on the specified addresses.
 
         param callback : callable
-            The callable that is called as callabale(msg, addr) whenever a message is received.
+            The callable that is called as callable(batch) whenever messages are received.
+            batch is a list of (msg, addr) tuples. If it returns False, the batch was
+            refused: the server stops reading from the socket and calls it again with
+            the same batch every RESUME_INTERVAL seconds until it is accepted.
         param conf_root : unicode
             Path to the root of the configuration tree
+        param dgram_callback : callable
+            If specified, used instead of callback for messages received over datagram sockets
         param listen_ipv4 : comma separated basestring of addresses
             Addresses to listen on for TCP and UDP connections
         param listen_ipv6 : comma separated basestring of addresses
@@ -62,11 +264,26 @@ class Server(object):
             File path to the pem file containing private and public keys for SSL/TLS
         param cacert : unicode
             File path to the cacert file with which the public key in pemfile is signed
+        param poller : basestring
+            Event notification backend: auto, epoll, poll or select
+        param udp_batch_size : int
+            Maximum number of datagrams to read from a UDP socket per wakeup
+        param udp_rcvbuf : int
+            If non-zero, SO_RCVBUF to set on UDP sockets, in bytes
+        param reuse_port : bool
+            Whether to set SO_REUSEPORT so that several processes can listen on the same addresses
+        param ssl_handshake_timeout : int
+            Seconds after which SSL/TLS clients that have not completed the handshake are disconnected
+        param unix_listeners : list
+            UNIX domain sockets as returned by open_unix_listeners(). If None, the server
+            opens the sockets configured in listen_unix_stream and listen_unix_dgram itself
+            and removes them on close.
         '''
 
         self.log = logging.getLogger('server') # internal logger
 
         self.callback = callback
+        self.dgram_callback = dgram_callback or callback
         self.closed = False
 
         self.stream_socks = set()
@@ -78,10 +295,33 @@ class Server(object):
 
         self.client_socket_addrs = {}
 
+        self.paused = {} # Socket -> (callback, refused batch), see submit()
+
+        self.handshakes = {} # SSL/TLS socket -> handshake deadline
+        self.ssl_context = None
+
+        self.timers = []
+
+        # All sockets watched by the poller, keyed by file descriptor
+        self.socks = {}
+        self.poller = create_poller(poller if poller is not None else options.server.poller)
+        self.log.info('Using the {0} poller.'.format(self.poller.name))
+
         self.select_timeout = None # Set on shutdown to prevent infinite wait
 
+        self.udp_batch_size = udp_batch_size if udp_batch_size is not None else options.server.udp_batch_size
+        self.udp_rcvbuf = udp_rcvbuf if udp_rcvbuf is not None else options.server.udp_rcvbuf
+
+        if self.udp_batch_size <= 0:
+            raise ServerStartupError('server.udp_batch_size must be a positive integer.')
+
+        self.reuse_port = reuse_port
+        if self.reuse_port and SO_REUSEPORT is None:
+            raise ServerStartupError('SO_REUSEPORT is not supported on this platform, so server.workers cannot be used.')
+
         self.pemfile = normalize_path(pemfile if pemfile is not None else options.server.pemfile, conf_root)
         self.cacert = normalize_path(cacert if cacert is not None else options.server.cacert, conf_root)
+        self.ssl_handshake_timeout = ssl_handshake_timeout if ssl_handshake_timeout is not None else options.server.ssl_handshake_timeout
 
         # Initialize server sockets
         listen_ipv4 = listen_ipv4 if listen_ipv4 is not None else options.server.listen_ipv4
@@ -105,6 +345,10 @@ class Server(object):
         default_port_ssl = default_port_ssl if default_port_ssl is not None else options.server.default_port_ssl
 
         self.validate_ssl_config(listen_ipv4_ssl, listen_ipv6_ssl)
+
+        if listen_ipv4_ssl or listen_ipv6_ssl:
+            self.ssl_context = self.create_ssl_context()
+            self.add_timer(1, self.expire_handshakes)
         
         ipv4_addrs_ssl = parse_addrs(listen_ipv4_ssl, default_port_ssl)
         ipv6_addrs_ssl = parse_addrs(listen_ipv6_ssl, default_port_ssl)
@@ -119,7 +363,20 @@ class Server(object):
             self.stream_socks.add(s)
             self.ssl_socks.add(s)
 
-        self.all_socks = set(self.stream_socks | self.dgram_socks)
+        # UNIX domain sockets
+        self.owns_unix_listeners = unix_listeners is None
+        self.unix_listeners = open_unix_listeners(conf_root, backlog=self.STREAM_SOCKET_BACKLOG) if unix_listeners is None else unix_listeners
+
+        self.unix_socket_addrs = {}
+        for sock, proto, address in self.unix_listeners:
+            if proto == socket.SOCK_STREAM:
+                self.stream_socks.add(sock)
+            else:
+                self.dgram_socks.add(sock)
+            self.unix_socket_addrs[sock] = address['filename']
+
+        for sock in self.stream_socks | self.dgram_socks:
+            self.add_socket(sock)
 
     def validate_ssl_config(self, listen_ipv4_ssl, listen_ipv6_ssl):
         '''Validates all SSL options at startup to prevent runtime errors.
@@ -147,12 +404,38 @@ class Server(object):
         if not os.access(self.cacert, os.R_OK):
             raise ServerStartupError('{0} is not readable by the current user.'.format(self.cacert))
 
+    def create_ssl_context(self):
+        '''Returns the SSLContext shared by all SSL/TLS connections.
+
+        Keys and certificates are only loaded once, at startup. Since all
+        connections share the context, OpenSSL's server-side session cache
+        and session tickets let reconnecting clients resume their sessions
+        instead of performing a full handshake.'''
+
+        if not hasattr(ssl, 'SSLContext'):
+            raise ServerStartupError('SSL/TLS listeners require Python 2.7.9 or newer.')
+
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+
+        try:
+            context.load_cert_chain(self.pemfile)
+            context.load_verify_locations(self.cacert)
+        except (ssl.SSLError, IOError) as e:
+            raise ServerStartupError('Could not load SSL/TLS keys and certificates: {0}'.format(e))
+
+        context.verify_mode = ssl.CERT_REQUIRED
+
+        return context
+
     def connect(self, address, family, proto, use_ssl=False):
         '''Returns a socket for a given addres, family and protocol.'''
 
         sock = socket.socket(family, proto)
 
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
         if 'host' in address and 'port' in address:
             addr = (address['host'], address['port'])
         elif 'filename' in address:
@@ -163,104 +446,310 @@ class Server(object):
 
         if proto == socket.SOCK_STREAM:
             sock.listen(self.STREAM_SOCKET_BACKLOG)
-        
+        else:
+            # Datagram sockets are drained until EAGAIN, see recv_datagrams()
+            sock.setblocking(0)
+
+            if self.udp_rcvbuf:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.udp_rcvbuf)
+                self.log.info('Receive buffer size is {0} bytes.'.format(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)))
+
         self.log.info(format_connection_message(address, family, proto, use_ssl))
 
         return sock
 
-    def run(self):
-        '''Runs the main loop, collecting data and sending it to the callback.'''
+    def add_socket(self, sock, events=POLL_READ):
+        '''Starts watching the socket for events in the main loop.'''
 
-        while True:
+        fd = sock.fileno()
+        self.poller.register(fd, events)
+        self.socks[fd] = sock
+
+    def remove_socket(self, sock):
+        '''Stops watching the socket. This must be done before the socket is closed.'''
+
+        try:
+            fd = sock.fileno()
+        except socket.error:
+            return # Already closed
+
+        if self.socks.get(fd) is sock:
+            self.poller.unregister(fd)
+            del self.socks[fd]
+
+    def add_timer(self, interval, callback):
+        '''Calls callback() from the main loop every interval seconds.'''
+
+        self.timers.append([time.time() + interval, interval, callback])
+
+    def run_timers(self):
+        '''Runs all the timers that are due.'''
+
+        now = time.time()
+        for timer in self.timers:
+            next_run, interval, callback = timer
+            if next_run > now:
+                continue
+
+            timer[0] = now + interval
             try:
-                if self.select_timeout:
-                    r, w, _ = select.select(self.all_socks, [], [], self.select_timeout)
-                else:
-                    r, w, _ = select.select(self.all_socks, [], [])
-            except Exception as exc:
-                if isinstance(exc, select.error) and exc.args[0] == 4:
-                    continue # Got signal, probably HUP
-                else:
-                    raise
+                callback()
+            except Exception as e:
+                self.log.exception(e)
 
-            for sock in r:
-                if sock in self.dgram_socks:
-                    # Receive datagram
-                    msg, addr = sock.recvfrom(self.MAX_MSG_SIZE)
-                    payload, _ = self.parse_datagram(msg)
-                    self.callback(payload, addr)
+    def get_poll_timeout(self):
+        '''Returns how long the poller may block before a timer is due.'''
 
-                elif sock in self.stream_socks:
-                    # Accept new stream
-                    clientsock, addr = sock.accept()
-                    try:
-                        self.connect_client_stream(clientsock, addr, use_ssl=(sock in self.ssl_socks))
-                    except (socket.error, ssl.SSLError) as e:
-                        self.log.exception(e)
-
-                elif sock in self.client_stream_socks:
-                    # Read client data
-                    try:
-                        data = sock.read(self.BUFSIZE) if isinstance(sock, ssl.SSLSocket) else sock.recv(self.BUFSIZE)
-                    except Exception as e:
-                        self.log.error('An error occured reading data from client at {0}'.format(self.client_socket_addrs[sock]))
-                        self.log.exception(e)
-                        self.disconnect_client_stream(sock)
-                        continue
-
-                    if data:
-                        self.stream_buffers[sock].append(data)
-                    
-                    try:
-                        for msg in self.parse_stream_buffer(sock):
-                            self.callback(msg, self.client_socket_addrs[sock])
-                    except Exception as e:
-                        self.log.error('Malformed client data from {0}. Disconnecting and flushing buffers.'.format(self.client_socket_addrs[sock]))
-                        self.log.exception(e)
-                        self.disconnect_client_stream(sock)
-
-                    if not data:
-                        self.disconnect_client_stream(sock)
+        timeout = self.select_timeout
+        if self.timers:
+            wait = max(0, min(t[0] for t in self.timers) - time.time())
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        if self.paused:
+            timeout = self.RESUME_INTERVAL if timeout is None else min(timeout, self.RESUME_INTERVAL)
+
+        return timeout
+
+    def run(self):
+        '''Runs the main loop, collecting data and sending it to the callback.'''
+
+        while True:
+            self.run_once(self.get_poll_timeout())
 
             if self.closed:
                 self.close()
                 break
 
+    def run_once(self, timeout):
+        '''Waits for up to timeout seconds and handles all the events that occured.'''
+
+        events = self.poller.poll(timeout)
+
+        if self.paused:
+            self.resume()
+
+        for fd, _ in events:
+            sock = self.socks.get(fd)
+            if sock is None:
+                continue # Disconnected earlier in this iteration
+
+            if sock in self.dgram_socks:
+                # Receive datagrams
+                batch = self.recv_datagrams(sock)
+                if batch:
+                    self.submit(sock, self.dgram_callback, batch)
+
+            elif sock in self.stream_socks:
+                # Accept new stream
+                try:
+                    clientsock, addr = sock.accept()
+                except socket.error as e:
+                    if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue # Shared listener: another process got there first
+                    raise
+
+                # UNIX domain clients are usually unnamed, so identify them by the listener
+                addr = addr or self.unix_socket_addrs.get(sock)
+
+                try:
+                    self.connect_client_stream(clientsock, addr, use_ssl=(sock in self.ssl_socks))
+                except (socket.error, ssl.SSLError) as e:
+                    self.log.exception(e)
+
+            elif sock in self.handshakes:
+                self.continue_handshake(sock)
+
+            elif sock in self.client_stream_socks:
+                self.read_client_stream(sock)
+
+        self.run_timers()
+
+    def submit(self, sock, callback, batch):
+        '''Passes the batch read from sock to the callback. Returns False if it was refused.
+
+        A refused batch is kept, and the socket is taken out of the poller
+        so that no more data is read from it until resume() gets the batch
+        accepted. Unread data waits in the kernel's socket buffers, which
+        slows stream clients down instead of stopping the whole loop.'''
+
+        if callback(batch) is not False:
+            return True
+
+        self.paused[sock] = (callback, batch)
+        self.poller.unregister(sock.fileno())
+
+        return False
+
+    def resume(self):
+        '''Submits the refused batches again, and resumes reading from the sockets whose batch is accepted.'''
+
+        for sock, (callback, batch) in list(self.paused.items()):
+            if callback(batch) is False:
+                continue
+
+            del self.paused[sock]
+            self.poller.register(sock.fileno(), POLL_READ)
+
+            # Decrypted data left in the SSL buffer does not wake up the poller
+            if isinstance(sock, ssl.SSLSocket) and sock in self.client_stream_socks and sock.pending():
+                self.read_client_stream(sock)
+
+    def read_client_stream(self, sock):
+        '''Reads client data and passes all the complete messages to the callback.'''
+
+        while True:
+            try:
+                received = self.stream_buffers[sock].recv_into(sock, self.BUFSIZE)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError):
+                return # Only part of a TLS record has arrived
+            except Exception as e:
+                self.log.error('An error occured reading data from client at {0}'.format(self.client_socket_addrs[sock]))
+                self.log.exception(e)
+                self.disconnect_client_stream(sock)
+                return
+
+            try:
+                addr = self.client_socket_addrs[sock]
+                batch = [(msg, addr) for msg in self.parse_stream_buffer(sock)]
+                if batch and not self.submit(sock, self.callback, batch):
+                    return # Also at the end of the stream: the next read after resume() sees it again
+            except Exception as e:
+                self.log.error('Malformed client data from {0}. Disconnecting and flushing buffers.'.format(self.client_socket_addrs[sock]))
+                self.log.exception(e)
+                self.disconnect_client_stream(sock)
+                return
+
+            if not received:
+                self.disconnect_client_stream(sock)
+                return
+
+            # Decrypted data left in the SSL buffer does not wake up the poller
+            if not (isinstance(sock, ssl.SSLSocket) and sock.pending()):
+                return
+
+    def recv_datagrams(self, sock):
+        '''Reads up to udp_batch_size datagrams from a non-blocking socket.
+
+        Returns a list of (payload, addr) tuples.'''
+
+        batch = []
+        for _ in xrange(self.udp_batch_size):
+            try:
+                msg, addr = sock.recvfrom(self.MAX_MSG_SIZE)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break # Drained
+                raise
+
+            try:
+                payload, _ = self.parse_datagram(msg)
+            except Exception as e:
+                self.log.error('Malformed datagram from {0}.'.format(addr))
+                self.log.exception(e)
+                continue
+
+            if payload is None:
+                self.log.warning('Truncated datagram from {0}. Discarding.'.format(addr))
+                continue
+
+            addr = addr or self.unix_socket_addrs.get(sock)
+            if isinstance(payload, list):
+                batch.extend((msg, addr) for msg in payload)
+            else:
+                batch.append((payload, addr))
+
+        return batch
+
     def connect_client_stream(self, sock, addr, use_ssl):
-        '''Adds a new socket to the list of stream sockets.'''
+        '''Adds a new socket to the list of stream sockets.
+
+        SSL/TLS sockets are wrapped without performing the handshake. The
+        handshake is then driven by the main loop, see continue_handshake().'''
 
         try:
             if use_ssl:
-                sock = ssl.wrap_socket(sock,
-                    keyfile=self.pemfile,
-                    certfile=self.pemfile,
-                    ca_certs=self.cacert,
-                    server_side=True,
-                    cert_reqs=ssl.CERT_REQUIRED,
-                )
-
-            self.client_socket_addrs[sock] = addr
-            self.client_stream_socks.add(sock)
-            self.all_socks.add(sock)
-            self.stream_buffers[sock] = []
+                sock.setblocking(0)
+                sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+
+                self.client_socket_addrs[sock] = addr
+                self.handshakes[sock] = time.time() + self.ssl_handshake_timeout
+                self.add_socket(sock)
+
+                self.continue_handshake(sock)
+            else:
+                self.client_socket_addrs[sock] = addr
+                self.add_client_stream(sock)
         except Exception as e:
             self.disconnect_client_stream(sock)
             self.log.exception(e)
 
+    def add_client_stream(self, sock):
+        '''Starts reading messages from a connected (and for SSL/TLS, handshaken) client.'''
+
+        self.client_stream_socks.add(sock)
+        self.stream_buffers[sock] = StreamBuffer(self.BUFSIZE * 2)
+
+        if sock.fileno() in self.socks:
+            self.poller.modify(sock.fileno(), POLL_READ)
+        else:
+            self.add_socket(sock)
+
+    def continue_handshake(self, sock):
+        '''Advances the SSL/TLS handshake as far as possible without blocking.'''
+
+        try:
+            sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.poller.modify(sock.fileno(), POLL_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self.poller.modify(sock.fileno(), POLL_WRITE)
+            return
+        except (ssl.SSLError, socket.error) as e:
+            self.log.warning('SSL/TLS handshake with {0} failed: {1}'.format(self.client_socket_addrs[sock], e))
+            self.disconnect_client_stream(sock)
+            return
+
+        del self.handshakes[sock]
+        self.add_client_stream(sock)
+
+        if sock.pending():
+            self.read_client_stream(sock)
+
+    def expire_handshakes(self):
+        '''Disconnects SSL/TLS clients that take too long to complete the handshake.'''
+
+        now = time.time()
+        for sock, deadline in self.handshakes.items():
+            if deadline <= now:
+                self.log.warning('SSL/TLS handshake with {0} timed out.'.format(self.client_socket_addrs[sock]))
+                self.disconnect_client_stream(sock)
+
     def disconnect_client_stream(self, sock):
         '''Removes all references to a client stream.'''
 
         if sock in self.client_stream_socks:
             self.client_stream_socks.remove(sock)
 
-        if sock in self.all_socks:
-            self.all_socks.remove(sock)
-        
-        if sock in self.client_socket_addrs:
-            del self.client_socket_addrs[sock]
+        if sock in self.handshakes:
+            del self.handshakes[sock]
+
+        if sock in self.paused:
+            _, batch = self.paused.pop(sock)
+            self.log.warning('Disconnected {0} with {1} messages not yet processed.'.format(self.client_socket_addrs.get(sock), len(batch)))
+
+        self.remove_socket(sock)
 
         if sock in self.stream_buffers:
-            del self.stream_buffers[sock]
+            buf = self.stream_buffers.pop(sock)
+
+            ratio = buf.compression_ratio()
+            if ratio is not None:
+                self.log.info('Connection from {0} closed. Compressed stream: {1} bytes in, {2} bytes out, ratio {3:.2f}.'.format(
+                    self.client_socket_addrs.get(sock), buf.compressed_bytes, buf.decompressed_bytes, ratio))
+
+        if sock in self.client_socket_addrs:
+            del self.client_socket_addrs[sock]
 
         try:
             sock.close()
@@ -270,52 +759,108 @@ class Server(object):
     def parse_stream_buffer(self, sock):
         '''Parses all the complete packets from the buffer and returns a generator.'''
 
-        buf = ''.join(self.stream_buffers[sock])
-        if len(buf) < self.HEADER_SIZE:
-            return
+        buf = self.stream_buffers[sock]
 
-        while True:
-            if len(buf) > self.HEADER_SIZE:
-                payload, buf = self.parse_datagram(buf)
-                if payload:
-                    yield payload
-                else:
-                    break
-            else:
+        while len(buf) >= self.HEADER_SIZE:
+            payload, offset = self.parse_datagram(buf.data, buf.start, buf.end, stream=buf)
+            if payload is None:
                 break
 
-        self.stream_buffers[sock] = [] if not buf else [buf]
+            buf.start = offset
 
-    def parse_datagram(self, buf):
-        '''If the buf bytestring contains a full datagram, extracts and parses it.
+            if isinstance(payload, list):
+                for msg in payload:
+                    yield msg
+            else:
+                yield payload
+
+    def parse_datagram(self, buf, offset=0, end=None, stream=None):
+        '''If the buf contains a full datagram at offset, extracts and parses it.
+
+        buf may be a bytestring or a bytearray. Only the bytes between offset
+        and end (the end of buf by default) are considered.
 
-        This method returns a 2-tuple of (payload, buf) where the payload is a
+        This method returns a 2-tuple of (payload, offset) where the payload is a
         bytestring payload of the datagram, with the wire-protocol headers stripped,
-        and buf - the modified buffer with the datagram removed.
+        and offset is the position in buf right after the datagram. For batch
+        frames, the payload is a list of bytestrings instead.
 
-        If the passed-in buf does not contain a full datagram, (None, None) is returned.'''
+        If buf does not contain a full datagram, (None, offset) is returned with
+        the offset unchanged.
 
-        size, flags = struct.unpack(self.HEADER_FORMAT, buf[:self.HEADER_SIZE])
-        if len(buf) >= self.HEADER_SIZE + size:
-            payload = struct.unpack(self.MSG_FORMAT_PROTO % size, buf[self.HEADER_SIZE:size+self.HEADER_SIZE])[0]
-            buf = buf[self.HEADER_SIZE + size:]
+        stream is the StreamBuffer of the connection the data was read from. It
+        is required to decode frames that use streaming compression.'''
 
-            if flags & self._FLAGS_GZIP:
-                payload = zlib.decompress(payload)
+        if end is None:
+            end = len(buf)
 
-            return payload, buf
-        else:
-            return None, buf
+        if end - offset < self.HEADER_SIZE:
+            return None, offset
+
+        size, flags = struct.unpack_from(self.HEADER_FORMAT, buf, offset)
+
+        start = offset + self.HEADER_SIZE
+        if end - start < size:
+            return None, offset
+
+        payload = memoryview(buf)[start:start + size].tobytes()
+
+        if flags & self._FLAGS_ZLIB_STREAM:
+            if stream is None:
+                raise ServerError('Streaming compression is only supported on stream connections.')
+            payload = stream.decompress(payload)
+
+        if flags & self._FLAGS_GZIP:
+            payload = zlib.decompress(payload)
+
+        if flags & self._FLAGS_BATCH:
+            payload = self.unpack_batch(payload)
+
+        return payload, start + size
+
+    def unpack_batch(self, payload):
+        '''Splits the payload of a batch frame into a list of message bytestrings.'''
+
+        messages = []
+
+        offset, end = 0, len(payload)
+        while offset < end:
+            if end - offset < self.BATCH_ITEM_SIZE:
+                raise ServerError('Truncated message header in a batch frame.')
+
+            size, = struct.unpack_from(self.BATCH_ITEM_FORMAT, payload, offset)
+            offset += self.BATCH_ITEM_SIZE
+
+            if end - offset < size:
+                raise ServerError('Truncated message in a batch frame.')
+
+            messages.append(payload[offset:offset + size])
+            offset += size
+
+        return messages
 
     def close(self):
+        # Hand over the refused batches while the processing threads are still running
+        while self.paused:
+            self.resume()
+            if self.paused:
+                time.sleep(self.RESUME_INTERVAL)
+
         for sock in self.client_stream_socks:
             sock.shutdown(socket.SHUT_RDWR)
 
         if self.client_stream_socks:
             time.sleep(self.SHUTDOWN_TIMEOUT)
 
-        for sock in self.all_socks:
-            sock.close()
+        for sock in self.socks.values():
+            self.remove_socket(sock)
+            if sock not in self.unix_socket_addrs:
+                sock.close()
+
+        if self.owns_unix_listeners:
+            close_unix_listeners(self.unix_listeners)
+
+        self.poller.close()
 
     def shutdown(self):
         '''Notifies the server of a shutdown condition.'''
@@ -1,5 +1,9 @@
 
-import re, socket, os.path, hashlib
+import re, socket, os, os.path, hashlib, bisect, errno, threading
+try:
+    import ctypes, ctypes.util
+except ImportError:
+    ctypes = None
 
 str_to_addrs = lambda s: tuple([x for x in [a.strip() for a in s.strip().split(',')] if x])
 
@@ -21,6 +25,15 @@ def parse_addrs(addrs_str, default_port):
 
     return result
     
+def parse_unix_addrs(addrs_str):
+    '''Parses comma separated list of UNIX socket paths into an iterable of normalized address dicts.
+
+    Example of params and results:
+        ('/var/run/loghogd/stream.sock, /tmp/loghog.sock') => [{'filename': '/var/run/loghogd/stream.sock'}, {'filename': '/tmp/loghog.sock'}]
+    '''
+
+    return [{'filename': filename} for filename in str_to_addrs(addrs_str)]
+
 def normalize_inet_addr(addr, default_port):
     '''Takes in an IP address string and a default port and returns a normalized (addr, port) tuple.'''
 
@@ -77,6 +90,9 @@ def format_connection_message(address, family, proto, use_ssl):
 def pretty_addr(addr):
     '''Converts a full address as returned by socket.accept() to a human-readable format.'''
 
+    if addr is None or isinstance(addr, basestring):
+        return addr or 'unnamed UNIX socket'
+
     if len(addr) == 2:
         return '{0}:{1}'.format(*addr)
 
@@ -104,3 +120,91 @@ def get_file_md5(filename):
     with open(filename, 'rb') as f:
         return hashlib.md5(f.read()).hexdigest()
 
+FALLOC_FL_KEEP_SIZE = 0x01 # From linux/falloc.h
+
+def load_fallocate():
+    '''Returns the C library's fallocate() through ctypes, or None if it is not available.'''
+
+    if ctypes is None:
+        return None
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except OSError:
+        return None
+
+    # fallocate64() takes 64 bit offsets on 32 bit systems as well
+    for name in ('fallocate64', 'fallocate'):
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+            func.restype = ctypes.c_int
+            return func
+
+    return None
+
+_fallocate = load_fallocate()
+
+def fallocate_keep_size(fd, offset, length):
+    '''Allocates disk space for a range of the file without changing its size.
+
+    Appending to the file then fills space that is already allocated. Raises
+    OSError on failure, with errno ENOSYS if fallocate() is not available and
+    EOPNOTSUPP if the file system does not support it.'''
+
+    if _fallocate is None:
+        raise OSError(errno.ENOSYS, 'fallocate() is not available on this system')
+
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+
+class LatencyHistogram(object):
+    '''Counts durations in buckets of exponentially growing width.
+
+    Durations may be added by one thread while another one takes them.'''
+
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0) # Upper bounds, in seconds
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1) # The last bucket has no upper bound
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        '''Records a single duration.'''
+
+        with self.lock:
+            self.counts[bisect.bisect_right(self.BUCKETS, seconds)] += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def take(self):
+        '''Returns a copy of the histogram and resets it.'''
+
+        copy = LatencyHistogram()
+
+        with self.lock:
+            copy.counts, copy.total, copy.max = self.counts, self.total, self.max
+            self.reset()
+
+        return copy
+
+    def count(self):
+        return sum(self.counts)
+
+    def format(self):
+        '''Returns a one line summary, listing the non-empty buckets.'''
+
+        n = self.count()
+        if not n:
+            return 'no samples'
+
+        labels = ['<{0:g}ms'.format(bound * 1000) for bound in self.BUCKETS] + ['>={0:g}ms'.format(self.BUCKETS[-1] * 1000)]
+        buckets = ', '.join('{0}: {1}'.format(label, c) for label, c in zip(labels, self.counts) if c)
+
+        return '{0} samples, avg {1:.2f}ms, max {2:.2f}ms ({3})'.format(n, self.total / n * 1000, self.max * 1000, buckets)
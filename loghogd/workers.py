@@ -0,0 +1,318 @@
+import os, socket, signal, marshal, logging, errno, time, struct, threading
+
+from poller import create_poller, POLL_READ
+
+class WorkerError(Exception):
+    '''Raised when the ingest worker processes cannot be managed.'''
+
+# Each packet sent to the parent is preceded by its length
+PACKET_HEADER = struct.Struct('!L')
+
+class RemoteWriter(object):
+    '''Stands in for a Writer inside ingest worker processes.
+
+    Messages are not written to disk by the workers. Instead they are sent
+    to the parent process, which owns every log file. This way each message
+    is written exactly once, and rotation state is kept in a single place.
+    '''
+
+    MAX_PACKET_SIZE = 1024 * 64 # Larger batches are split. A single record may be larger.
+
+    def __init__(self, sock):
+        '''Initializes the RemoteWriter with the worker end of the socket pair.'''
+
+        self.sock = sock
+
+        # Packets may be sent by several processing threads at once, and
+        # a packet that takes more than one send() must not be interleaved
+        self.lock = threading.Lock()
+
+    def write_many(self, records):
+        '''Forwards a list of (facility, msg) tuples to the parent process.
+
+        Facilities are sent as (app_id, mod_id) and looked up again by the parent.
+        The records are sent as a single packet, unless it would be larger
+        than MAX_PACKET_SIZE.'''
+
+        self.send_records([(facility.app_id, facility.mod_id, msg) for facility, msg in records])
+
+    def send_records(self, records):
+        '''Sends a list of (app_id, mod_id, msg) tuples, split into packets of at most MAX_PACKET_SIZE.'''
+
+        packet = marshal.dumps(records)
+
+        if len(packet) > self.MAX_PACKET_SIZE and len(records) > 1:
+            half = len(records) // 2
+            self.send_records(records[:half])
+            self.send_records(records[half:])
+            return
+
+        self.send(packet)
+
+    def send(self, packet):
+        '''Sends the packet with its length, retrying if interrupted by a signal.'''
+
+        data = PACKET_HEADER.pack(len(packet)) + packet
+
+        with self.lock:
+            while data:
+                try:
+                    sent = self.sock.send(data)
+                except socket.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+
+                data = data[sent:]
+
+class WorkerPool(object):
+    '''Manages a set of forked ingest processes.
+
+    Each worker runs its own Server and Processor, and binds the same listen
+    addresses using SO_REUSEPORT so that the kernel balances connections and
+    datagrams between them. Parsed messages are sent back to the parent over
+    a UNIX stream socket pair as length prefixed packets, so that there is no
+    limit on the size of a message, and the parent acts as the single writer.
+    The parent's main loop is implemented in the run() method.
+    '''
+
+    CHECK_INTERVAL = 1.0 # How often to check whether workers are alive, in seconds
+    RECV_SIZE = RemoteWriter.MAX_PACKET_SIZE
+
+    def __init__(self, num_workers, facility_db, writer, run_worker):
+        '''Initializes the pool. No processes are started until start() is called.
+
+        param num_workers : int
+            Number of ingest processes to run
+        param facility_db : FacilityDB
+            Used to look up the facilities of the messages received from the workers
+        param writer : Writer
+            The Writer instance that will receive all the messages in the parent
+        param run_worker : callable
+            Called as run_worker(remote_writer) in each worker process. It should
+            run the worker's main loop and return on shutdown.
+        '''
+
+        if num_workers <= 0:
+            raise WorkerError('server.workers must be a positive integer.')
+
+        self.log = logging.getLogger('workers') # internal logger
+
+        self.num_workers = num_workers
+        self.facility_db = facility_db
+        self.writer = writer
+        self.run_worker = run_worker
+
+        self.workers = {} # pid -> parent end of the socket pair
+        self.socks = {} # fd -> socket
+        self.buffers = {} # fd -> bytearray of data received but not yet unpacked
+
+        self.poller = create_poller()
+        self.closed = False
+        self.failed = False # Set if a worker died, see reap()
+
+        self.timers = [] # [next run, interval, callback]
+
+    def start(self):
+        '''Forks all the worker processes. Must be called before any threads are started.'''
+
+        for _ in xrange(self.num_workers):
+            self.spawn()
+
+    def spawn(self):
+        '''Forks a single worker process.'''
+
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        pid = os.fork()
+        if pid == 0:
+            # Worker process. Never returns.
+            status = 0
+            try:
+                parent_sock.close()
+                for sock in self.socks.values():
+                    sock.close()
+                self.poller.close()
+
+                for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+                    signal.signal(signum, signal.SIG_DFL)
+
+                self.run_worker(RemoteWriter(child_sock))
+            except Exception as e:
+                self.log.exception(e)
+                status = os.EX_SOFTWARE
+            finally:
+                # Skip atexit handlers: they belong to the parent
+                os._exit(status)
+
+        child_sock.close()
+        parent_sock.setblocking(0)
+
+        self.workers[pid] = parent_sock
+        self.socks[parent_sock.fileno()] = parent_sock
+        self.poller.register(parent_sock.fileno(), POLL_READ)
+
+        self.log.info('Started ingest worker {0}.'.format(pid))
+
+    def run(self):
+        '''Runs the parent's main loop, writing messages received from the workers.'''
+
+        while True:
+            for fd, _ in self.poller.poll(self.get_poll_timeout()):
+                sock = self.socks.get(fd)
+                if sock is not None:
+                    self.drain(sock)
+
+            self.reap()
+            self.run_timers()
+
+            if self.closed and not self.workers:
+                break
+
+        self.poller.close()
+
+    def add_timer(self, interval, callback):
+        '''Calls callback() from the main loop every interval seconds.'''
+
+        self.timers.append([time.time() + interval, interval, callback])
+
+    def run_timers(self):
+        '''Runs all the timers that are due.'''
+
+        now = time.time()
+        for timer in self.timers:
+            next_run, interval, callback = timer
+            if next_run > now:
+                continue
+
+            timer[0] = now + interval
+            try:
+                callback()
+            except Exception as e:
+                self.log.exception(e)
+
+    def get_poll_timeout(self):
+        '''Returns how long the poller may block before a timer is due or workers should be checked.'''
+
+        timeout = self.CHECK_INTERVAL
+        if self.timers:
+            timeout = min(timeout, max(0, min(t[0] for t in self.timers) - time.time()))
+
+        return timeout
+
+    def drain(self, sock):
+        '''Reads and writes out all the messages queued on the socket.
+
+        A packet that has only partly arrived is kept until the rest does.'''
+
+        buf = self.buffers.setdefault(sock.fileno(), bytearray())
+
+        while True:
+            try:
+                data = sock.recv(self.RECV_SIZE)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            if not data:
+                return
+
+            buf.extend(data)
+            self.unpack_packets(buf)
+
+    def unpack_packets(self, buf):
+        '''Writes out the complete packets at the start of buf and removes them from it.'''
+
+        offset = 0
+        while len(buf) - offset >= PACKET_HEADER.size:
+            size, = PACKET_HEADER.unpack_from(buf, offset)
+            end = offset + PACKET_HEADER.size + size
+            if len(buf) < end:
+                break
+
+            packet = bytes(buf[offset + PACKET_HEADER.size:end])
+            offset = end
+
+            try:
+                self.writer.write_many(self.resolve_records(marshal.loads(packet)))
+            except Exception as e:
+                self.log.error('An error occured writing a message from an ingest worker.')
+                self.log.exception(e)
+
+        del buf[:offset]
+
+    def resolve_records(self, records):
+        '''Turns (app_id, mod_id, msg) tuples received from a worker into (facility, msg) tuples.'''
+
+        result = []
+        for app_id, mod_id, msg in records:
+            facility = self.facility_db.get_facility(app_id, mod_id)
+            if facility:
+                result.append((facility, msg))
+            else:
+                # The facility was removed by a reload after the worker looked it up
+                self.log.warning('Could not find facility {0}:{1} for a message from an ingest worker.'.format(app_id, '.'.join(mod_id)))
+
+        return result
+
+    def reap(self):
+        '''Collects exited workers. If one exits unexpectedly, shuts down.
+
+        Workers are not replaced: by then the parent runs the writer's and
+        the compressor's threads, and a process forked from a multithreaded
+        one may inherit a lock held by another thread, such as a logging or
+        a Queue lock, and deadlock. Sets failed, so that main() can exit with
+        an error and let the init system restart loghogd.'''
+
+        for pid, sock in self.workers.items():
+            try:
+                exited, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                exited, status = pid, 0
+
+            if not exited:
+                continue
+
+            # Anything the worker sent before exiting is still queued
+            self.drain(sock)
+
+            self.poller.unregister(sock.fileno())
+            del self.socks[sock.fileno()]
+            self.buffers.pop(sock.fileno(), None)
+            del self.workers[pid]
+            sock.close()
+
+            if self.closed:
+                self.log.info('Ingest worker {0} exited.'.format(pid))
+                continue
+
+            self.log.error('Ingest worker {0} exited unexpectedly with status {1}. Shutting down.'.format(pid, status))
+
+            self.failed = True
+            self.shutdown()
+
+    def signal_workers(self, signum):
+        '''Sends the signal to all the workers.'''
+
+        for pid in self.workers:
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def reload(self):
+        '''Asks the workers to reload their facility configuration.'''
+
+        self.signal_workers(signal.SIGHUP)
+
+    def shutdown(self):
+        '''Asks the workers to exit. run() returns once they all have.'''
+
+        self.closed = True
+        self.signal_workers(signal.SIGTERM)
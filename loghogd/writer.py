@@ -1,8 +1,77 @@
 
-from __future__ import print_function, unicode_literals
-import os, datetime, time, logging, errno
+from __future__ import print_function, unicode_literals, with_statement
+import os, datetime, time, logging, errno, threading, heapq
+from collections import OrderedDict
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
 
 from scheduler import Scheduler
+from backups import BackupManager, BACKUP_STAMP
+from ext.croniter import croniter
+from util import LatencyHistogram, fallocate_keep_size
+from ext.groper import define_opt, options
+
+define_opt('writer', 'timestamp', default='server')
+define_opt('writer', 'queue_size', type=int, default=0)
+define_opt('writer', 'commit_interval', type=float, default=1.0)
+define_opt('writer', 'max_open_files', type=int, default=0)
+
+# fdatasync() skips metadata that is not needed to read the data back
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+class WriterError(Exception):
+    '''Raised when the Writer is misconfigured.'''
+
+class CountingFile(object):
+    '''Wraps a file object and counts the bytes written through it.
+
+    When compress_on_write is enabled, the GzipFile writes to this wrapper,
+    so the count is the compressed size on disk.'''
+
+    def __init__(self, f):
+        self.f = f
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.bytes_written += len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+class ClosingFile(object):
+    '''A log file that was swapped out while still open, see LogFile.detach().
+
+    Calling it does the slow part of closing the file: freeing the space
+    preallocated past its end, syncing its data and closing it. Rotation
+    leaves this to the BackupManager's thread, so that it is not done while
+    the writer's lock is held.'''
+
+    def __init__(self, f, raw_file, release, sync, sync_histogram=None):
+        self.file = f
+        self.raw_file = raw_file
+        self.release = release
+        self.sync = sync
+        self.sync_histogram = sync_histogram
+
+    def __call__(self):
+        try:
+            fd = self.raw_file.fileno()
+
+            if self.release:
+                os.ftruncate(fd, os.fstat(fd).st_size)
+
+            if self.sync:
+                started_at = time.time()
+                fdatasync(fd)
+
+                if self.sync_histogram is not None:
+                    self.sync_histogram.add(time.time() - started_at)
+        finally:
+            self.file.close()
+            self.raw_file.close() # Not closed by GzipFile when compress_on_write is enabled
 
 class LogFile(object):
     '''Instances of this class represent log files and their backups.
@@ -10,8 +79,34 @@ class LogFile(object):
     This class is able to write to the corresponding log file and rotate it.
     '''
 
-    def __init__(self, filename, scheduler, compressor, backup_count, max_size, rotate, flush_every):
-        '''Initializes and opens a LogFile instance.'''
+    SIZE_RECONCILE_INTERVAL = 300 # How often to check the running size against the file system, in seconds
+
+    def __init__(self, filename, scheduler, compressor, backup_count, max_size, rotate, flush_every, flush_interval=None, buffer_bytes=None, durability='none', sync_histogram=None, backups=None, bucket=None, preallocate=False):
+        '''Initializes and opens a LogFile instance.
+
+        Written data is buffered until flush_every messages, buffer_bytes bytes
+        or flush_interval seconds worth of data have accumulated, whichever
+        comes first. The last two limits are optional.
+
+        durability is the facility's durability mode. LogFile itself syncs
+        on every flush in "every" mode and on close in all modes but "none";
+        the Writer calls sync() for the other modes. If given, the duration
+        of each sync is added to sync_histogram.
+
+        backups is the BackupManager that takes over the backups made by
+        rotation. It is meant to be shared by all the files.
+
+        If bucket is given, the file is never renamed. Data goes to a file
+        named <filename>.<bucket>, bucket being a strftime pattern formatted
+        with the time the file was opened, and filename is a symlink to it.
+        Rotating the file opens the file of the new bucket and updates the
+        symlink. Such files are not rotated by size.
+
+        If preallocate is set, max_size bytes of disk space are allocated when
+        the file is opened, so that appends fill contiguous space instead of
+        growing the file a block at a time. The size of the file is not
+        changed, and the space that was not used is released when the file is
+        closed: on rotation, eviction and shutdown.'''
         
         self.log = logging.getLogger('writer.log_file') # internal logger
 
@@ -22,56 +117,285 @@ class LogFile(object):
         self.max_size = max_size
         self.rotate = rotate
         self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.buffer_bytes = buffer_bytes
+        self.durability = durability
+        self.sync_histogram = sync_histogram
+        self.backups = backups if backups is not None else BackupManager(compressor)
+        self.bucket = bucket
+        self.preallocate = preallocate and bool(max_size) and bucket is None
+        self.path = filename # The file data is written to, see get_bucket_path()
 
         self.dirty_writes = 0
-        self.size = 0
+        self.buffer = [] # Data waiting to be written out by flush()
+        self.buffered_bytes = 0
+        self.buffered_since = None # When the oldest data in the buffer was written
+        self.size = 0 # Running size of the file, as counted for max_size
+        self.size_checked_at = 0 # When size was last set from os.stat()
+        self.next_rotation_at = None # Set by open(), None if the file is only rotated by size
+        self.unsynced = False # Whether data was written since the last sync()
+        self.synced_at = 0
+        self.empty = True # Whether the file had no data when opened and nothing was written since
+        self.count_uncompressed = compressor.counts_uncompressed_size()
+        self.raw_file = None # CountingFile under self.file
         self.file = None
 
+        if self.bucket is not None:
+            self.backups.add_pattern(self.bucket)
+
         self.open()
 
     def open(self):
         '''Opens a file and creates the necessary records in the dbm database.'''
 
+        if self.bucket is not None:
+            return self.open_bucket()
+
+        self.open_file()
+
+        if self.preallocate:
+            self.allocate()
+
+        # The schedule is only consulted here, so that checking for rotation
+        # on every write is a simple comparison
+        if self.rotate != 'size':
+            self.next_rotation_at = self.scheduler.get_next_execution(self.filename, self.rotate, time.time())
+
+    def open_bucket(self):
+        '''Opens the file of the current time bucket and points the symlink at it.
+
+        The rotation schedule is computed from the current time, without
+        the dbm database. If the symlink pointed to another file, that file
+        is handed to the BackupManager.'''
+
+        now = time.time()
+
+        self.path = self.get_bucket_path(now)
+        self.open_file()
+
+        self.next_rotation_at = croniter(self.rotate, now).get_next()
+
+        previous = self.update_symlink()
+        if previous is not None and os.path.exists(previous):
+            unwrap = self.compressor.unwrap_filename
+            self.backups.add(unwrap(self.filename), unwrap(previous), self.backup_count, current=unwrap(self.path))
+
+    def get_bucket_path(self, now):
+        '''Returns the name of the file for the time bucket of now.'''
+
+        suffix = time.strftime(self.bucket, time.localtime(now))
+        return self.compressor.wrap_filename('{0}.{1}'.format(self.compressor.unwrap_filename(self.filename), suffix))
+
+    def update_symlink(self):
+        '''Points filename at the current bucket file. Returns the file it pointed to before, if any.
+
+        The symlink is replaced atomically, so that tailers always find a file.
+        A regular file in its place is left alone.'''
+
+        dirname = os.path.dirname(self.filename)
+        target = os.path.basename(self.path)
+
+        try:
+            previous = os.readlink(self.filename)
+        except OSError as e:
+            if e.errno == errno.EINVAL:
+                self.log.warning('{0} is not a symlink, so it cannot point to {1}. Leaving it alone.'.format(self.filename, target))
+                return None
+            elif e.errno == errno.ENOENT:
+                previous = None
+            else:
+                raise
+
+        if previous == target:
+            return None
+
+        tmp_filename = os.path.join(dirname, '.{0}.symlink'.format(os.path.basename(self.filename)))
         try:
-            os.makedirs(os.path.dirname(self.filename))
+            os.unlink(tmp_filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        os.symlink(target, tmp_filename)
+        os.rename(tmp_filename, self.filename)
+
+        return os.path.join(dirname, previous) if previous is not None else None
+
+    def open_file(self):
+        '''Opens the file for appending without touching the rotation schedule.
+
+        Used directly to reopen a file that was closed to save file descriptors.'''
+
+        try:
+            os.makedirs(os.path.dirname(self.path))
         except OSError as e:
             if e.errno == errno.EEXIST:
                 pass # Dir already exists
             else:
                 raise
         try:
-            fd = os.open(self.filename, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)
             
             # File does not exist
-            self.scheduler.record_execution(self.filename, time.time())
+            if self.bucket is None:
+                self.scheduler.record_execution(self.filename, time.time())
             f = os.fdopen(fd, 'ab', 0o644)
         except OSError as e:
             if e.errno == errno.EEXIST: # File exists
-                f = open(self.filename, 'ab', 0o644)
+                f = open(self.path, 'ab', 0o644)
             else:
                 raise
 
-        self.file = self.compressor.wrap_fileobj(f, os.path.basename(self.filename))
+        # Checked before compress_on_write writes a gzip header
+        self.empty = os.fstat(f.fileno()).st_size == 0
+
+        self.raw_file = CountingFile(f)
+        self.file = self.compressor.wrap_fileobj(self.raw_file, os.path.basename(self.path))
+
+        # When counting uncompressed bytes, an existing file's compressed
+        # size is used as the starting point: it is the best cheap estimate.
+        self.reconcile_size()
+
+    def allocate(self):
+        '''Preallocates max_size bytes for the file, without changing its size.
+
+        Preallocation is turned off for the file if the system does not support it.'''
+
+        try:
+            fallocate_keep_size(self.raw_file.fileno(), 0, self.max_size)
+        except OSError as e:
+            if e.errno in (errno.ENOSYS, errno.EOPNOTSUPP):
+                self.preallocate = False
+                self.log.warning('Cannot preallocate {0}: {1}. Preallocation is disabled for it.'.format(self.filename, e.strerror))
+            else:
+                self.log.warning('Could not preallocate {0}: {1}'.format(self.filename, e.strerror))
 
-        self.size = os.stat(self.filename).st_size
+    def is_open(self):
+        return self.file is not None
 
     def close(self):
-        '''Closes the log file.'''
+        '''Flushes and closes the log file, if it is open.
 
-        self.file.close()
+        The space preallocated past the end of the file is freed, and the
+        data is synced unless durability is none.'''
+
+        if self.file is None:
+            return
+
+        try:
+            self.flush()
+        finally:
+            self.detach()()
+
+    def detach(self):
+        '''Leaves the LogFile closed and returns a ClosingFile that closes the open file.
+
+        Data still buffered is not written out: flush() first.'''
+
+        closing = ClosingFile(self.file, self.raw_file, self.preallocate, self.unsynced and self.durability != 'none', self.sync_histogram)
+
+        self.file = self.raw_file = None
+        self.unsynced = False
+
+        return closing
+
+    def swap_out(self):
+        '''Flushes the file, if it is open, and has the BackupManager close it before any backup added later.'''
+
+        if self.file is None:
+            return
+
+        try:
+            self.flush()
+        finally:
+            self.backups.close(self.detach())
+
+    def write(self, data, count=1):
+        '''Buffers data for writing, flushing if any of the limits is reached.
+
+        count is the number of messages in data, used for flush_every.'''
+
+        if not self.buffer:
+            self.buffered_since = time.time()
+
+        self.empty = False
+        self.buffer.append(data)
+        self.buffered_bytes += len(data)
+        self.dirty_writes += count
 
-    def write(self, data):
-        '''Writes data to the file.'''
-        
-        self.file.write(data)
-        self.dirty_writes += 1
-        
         if self.dirty_writes >= self.flush_every:
-            self.file.flush()
-            self.dirty_writes = 0
+            self.flush()
+        elif self.buffer_bytes and self.buffered_bytes >= self.buffer_bytes:
+            self.flush()
+        elif self.flush_interval and self.is_stale():
+            self.flush()
+
+    def is_stale(self, now=None):
+        '''Returns True if buffered data is older than flush_interval.'''
+
+        if not (self.buffer and self.flush_interval):
+            return False
 
-            # Optimization: only check file size when flushing
-            self.size = os.stat(self.filename).st_size
+        return (now or time.time()) - self.buffered_since >= self.flush_interval
+
+    def flush(self):
+        '''Writes out all the buffered data with a single write.'''
+
+        if not self.buffer:
+            return
+
+        data = b''.join(self.buffer) if len(self.buffer) > 1 else self.buffer[0]
+
+        self.buffer = []
+        self.buffered_bytes = 0
+        self.buffered_since = None
+        self.dirty_writes = 0
+
+        written_before = self.raw_file.bytes_written
+
+        self.file.write(data)
+        self.file.flush()
+        self.unsynced = True
+
+        if self.durability == 'every':
+            self.sync_data()
+
+        if self.count_uncompressed:
+            self.size += len(data)
+        else:
+            self.size += self.raw_file.bytes_written - written_before
+
+            if time.time() - self.size_checked_at >= self.SIZE_RECONCILE_INTERVAL:
+                self.reconcile_size()
+
+    def sync(self):
+        '''Flushes the file and makes sure its data has reached the disk.'''
+
+        self.flush()
+        self.sync_data()
+
+        self.synced_at = time.time()
+
+    def sync_data(self):
+        '''Makes sure data already flushed has reached the disk.'''
+
+        if not self.unsynced:
+            return
+
+        started_at = time.time()
+        fdatasync(self.raw_file.fileno())
+        self.unsynced = False
+
+        if self.sync_histogram is not None:
+            self.sync_histogram.add(time.time() - started_at)
+
+    def reconcile_size(self):
+        '''Sets the running size from the file system.
+
+        This picks up changes made by other processes, such as truncation.'''
+
+        self.size = os.fstat(self.raw_file.fileno()).st_size
+        self.size_checked_at = time.time()
 
     def should_rotate(self):
         '''Figures out if the given file should be rotated.
@@ -80,71 +404,92 @@ class LogFile(object):
         :return: None or str with reason for rotation
         '''
 
-        if self.max_size:
-            if self.size >= self.max_size:
-                return 'max_size'
+        if self.is_full():
+            return 'max_size'
 
-        now = time.time()
-        
-        next_rotation_at = self.scheduler.get_next_execution(self.filename, self.rotate, now)
-
-        if next_rotation_at < now:
+        if self.next_rotation_at is not None and self.next_rotation_at < time.time():
             return self.rotate
 
+    def is_full(self):
+        '''Returns True if the file has reached max_size.'''
+
+        return bool(self.max_size) and self.bucket is None and self.size >= self.max_size
+
     def do_rotate(self):
-        '''Performs the file rotation.'''
+        '''Performs the file rotation, if it is due.
+
+        Only the file is swapped here. The old file is closed, old backups
+        are removed and the new backup is compressed by the BackupManager.
+
+        An empty file is not rotated, so that idle files do not leave empty
+        backups behind: only its next rotation time is moved on.'''
 
         reason = self.should_rotate()
         if not reason:
             return
 
+        if self.empty and self.bucket is None:
+            self.log.debug('Not rotating {0}: it is empty'.format(self.filename))
+
+            now = time.time()
+            self.scheduler.record_execution(self.filename, now)
+            self.next_rotation_at = self.scheduler.get_next_execution(self.filename, self.rotate, now)
+            return
+
         self.log.info('Rotating {0} based on "{1}"'.format(self.filename, reason))
-        
-        try:
-            # Close the file before renaming it
-            self.close()
 
-            last_rotation_dt = datetime.datetime.fromtimestamp(self.scheduler.get_last_execution(self.filename))
-            new_name = '{0}.{1}'.format(self.compressor.unwrap_filename(self.filename), last_rotation_dt.strftime('%Y-%m-%d-%H-%M-%S-%f'))
-            self._rename(self.filename, self.compressor.wrap_filename(new_name))
+        if self.bucket is not None:
+            # Nothing to rename: open_bucket() moves on to the next file.
+            # An empty bucket file is removed rather than kept as a backup.
+            empty_path = self.path if self.empty else None
+            self.swap_out()
+
+            if empty_path is not None:
+                self._unlink(empty_path)
 
-            self.remove_old_backups()
+            self.open()
+            return
 
-            self.compressor.compress(new_name)
+        try:
+            # Renaming the open file is fine: nothing is written to it anymore
+            self.swap_out()
+
+            try:
+                last_rotation_at = self.scheduler.get_last_execution(self.filename)
+            except KeyError:
+                last_rotation_at = time.time() # No record for a file that is only rotated by size
+
+            last_rotation_dt = datetime.datetime.fromtimestamp(last_rotation_at)
+            base_name = self.compressor.unwrap_filename(self.filename)
+            new_name = '{0}.{1}'.format(base_name, last_rotation_dt.strftime(BACKUP_STAMP))
+            if self._rename(self.filename, self.compressor.wrap_filename(new_name)):
+                self.backups.add(base_name, new_name, self.backup_count)
         finally:
             # Make sure that no matter what we try to open the file
             self.open()
 
-    def remove_old_backups(self):
-        '''Removes old backups after a file rotation.'''
-
-        prefix = os.path.basename(self.filename)
-        all_files = []
-        for root, dirs, files in os.walk(os.path.dirname(self.filename)):
-            for filename in files:
-                if filename.startswith(prefix):
-                    filename = os.path.join(root, filename)
-                    all_files.append(filename)
+    def _unlink(self, filename):
+        '''Removes filename if it exists.'''
 
-        all_files.sort()
-
-        to_remove = all_files[:-self.backup_count]
-
-        for filename in to_remove:
+        try:
             os.unlink(filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
     def _rename(self, src, dst):
-        '''Renames src to dst if src exists.'''
+        '''Renames src to dst if src exists. Returns whether it did.'''
 
         try:
             os.rename(src, dst)
         except OSError as e:
             if e.errno == errno.ENOENT:
-                return # No such file or directory
+                return False # No such file or directory
             else:
                 raise
 
         self.log.debug('Renamed {0} to {1}'.format(src, dst))
+        return True
 
 class Writer(object):
     '''Main writer class.
@@ -153,36 +498,244 @@ class Writer(object):
     the appropriate LogFile instances.
     '''
 
-    LOG_LINE_PROTO = '{0!s} - {1!s} - {2!s}\n'
+    FIELD_SEPARATOR = b' - '
+    TIMESTAMP_SOURCES = ('server', 'client')
+
+    TICK_INTERVAL = 1.0 # How often tick() should be called, in seconds
 
-    def __init__(self, facility_db, compressor, log_dir):
+    def __init__(self, facility_db, compressor, log_dir, scheduler=None, timestamp=None, queue_size=None, commit_interval=None, max_open_files=None):
         '''Initializes a Writer instance.
         
-        Take care not to initialize multiple writer instances for the same files.'''
+        Take care not to initialize multiple writer instances for the same files.
+
+        timestamp decides where the time at the start of each line comes from:
+        "server" uses the time the message is written, "client" uses the
+        stamp and nsecs fields of the message.
+
+        If queue_size is positive, start() runs a write-behind thread: writes
+        are queued and the thread writes them out, coalescing everything that
+        is waiting for a file into one write.
+
+        Files of facilities with durability = interval are synced to disk at
+        most once per commit_interval seconds.
+
+        If max_open_files is positive, at most that many files are kept open.
+        The least recently used file is closed to make room, and reopened
+        when it is written to again.
+
+        Files are rotated by size as they are written to, and by schedule from
+        tick() or the write-behind thread, whether they are written to or not.'''
 
         self.facility_db = facility_db
-        self.files = {}
+        self.files = {} # filename -> LogFile, open or not
+        self.open_files = OrderedDict() # filename -> open LogFile, least recently used first
 
         self.log_dir = log_dir
 
-        self.scheduler = Scheduler()
+        self.scheduler = scheduler or Scheduler()
 
         self.compressor = compressor
 
+        self.timestamp = timestamp or options.writer.timestamp
+        if self.timestamp not in self.TIMESTAMP_SOURCES:
+            raise WriterError('{0} is not a valid timestamp source. Valid options are: {1}.'.format(self.timestamp, ', '.join(self.TIMESTAMP_SOURCES)))
+
+        self.timestamp_cache = (None, None) # (second, formatted second), see format_timestamp()
+
+        self.queue_size = queue_size if queue_size is not None else options.writer.queue_size
+        self.commit_interval = commit_interval if commit_interval is not None else options.writer.commit_interval
+
+        self.queue = Queue(self.queue_size) if self.queue_size > 0 else None
+        self.thread = None # The write-behind thread, if running
+
+        self.max_open_files = max_open_files if max_open_files is not None else options.writer.max_open_files
+
+        self.rotations = [] # Heap of (when to check, filename), see rotate_due()
+        self.backups = BackupManager(compressor)
+        self.sync_histograms = {} # Facility name -> LatencyHistogram of fdatasync() durations
+
+        # Open file cache counters, reset by log_stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Writes may come from several processing threads, and reloads from signal handlers
+        self.lock = threading.RLock()
+
+        # Guards the counters and sync_histograms. It is never held across
+        # any I/O, so log_stats() does not wait for the disk like self.lock may.
+        self.stats_lock = threading.Lock()
+
         self.log = logging.getLogger('writer') # internal logger
 
-    def write(self, app_id, mod_id, msg):
-        '''Write the message to the appropriate file.'''
+    def start(self):
+        '''Starts the BackupManager thread and the write-behind thread, if enabled.'''
 
-        facility = self.facility_db.get_facility(app_id, mod_id)
+        self.backups.start()
 
-        log_file = self.get_file(msg['hostname'], facility)
+        if self.queue is not None:
+            self.thread = threading.Thread(target=self.run)
+            self.thread.start()
 
-        log_file.do_rotate()
-            
-        s = self.LOG_LINE_PROTO.format(datetime.datetime.now(), msg['hostname'], msg['body']).encode('utf8')
+    def write_many(self, records):
+        '''Writes a list of (facility, msg) tuples.
+
+        In write-behind mode, the records are queued, waiting for room if the
+        queue is full. Otherwise they are written out before returning.'''
+
+        if self.thread:
+            self.queue.put(records)
+        else:
+            self.write_records(records)
+
+    def write_records(self, records):
+        '''Writes a list of (facility, msg) tuples.
+
+        The messages are grouped by file, so that each file is checked for
+        size rotation once per call and written to with a single write. Each
+        file is only looked up, and opened if need be, when its group is
+        written, so that keeping under max_open_files never closes a file
+        that is about to be written to.'''
+
+        with self.lock:
+            for filename, hostname, facility, lines in self.group_by_file(records):
+                try:
+                    log_file = self.get_file(hostname, facility)
+
+                    if log_file.is_full():
+                        self.rotate_file(log_file)
+
+                    log_file.write(b''.join(lines), len(lines))
+
+                    if log_file.durability == 'batch':
+                        log_file.sync()
+                except Exception as e:
+                    self.log.error('An error occured writing {0} messages to {1}'.format(len(lines), filename))
+                    self.log.exception(e)
+
+    def run(self):
+        '''Main loop of the write-behind thread.'''
+
+        done = False
+        while not done:
+            records = []
+
+            try:
+                batch = self.queue.get(timeout=self.TICK_INTERVAL)
+
+                # Take everything that is already waiting, so that each file gets a single write
+                while batch is not None:
+                    records.extend(batch)
+                    batch = self.queue.get_nowait()
+
+                # None means "shut down now"
+                done = True
+            except Empty:
+                pass
+
+            try:
+                if records:
+                    self.write_records(records)
+
+                self.rotate_due()
+                self.flush_stale()
+                self.sync_files(force=done)
+            except Exception as e:
+                self.log.exception(e)
+
+    def sync_files(self, force=False):
+        '''Syncs the files of facilities with durability = interval.
+
+        A file is synced if it has unsynced data and its last sync was at least
+        commit_interval ago. With force, all files that have unsynced data and
+        a durability other than none are synced.'''
+
+        now = time.time()
+
+        with self.lock:
+            for log_file in self.open_files.values():
+                if not (log_file.unsynced or log_file.buffer):
+                    continue
+
+                if force:
+                    if log_file.durability == 'none':
+                        continue
+                elif log_file.durability != 'interval' or now - log_file.synced_at < self.commit_interval:
+                    continue
+
+                try:
+                    log_file.sync()
+                except Exception as e:
+                    self.log.error('An error occured syncing {0}'.format(log_file.filename))
+                    self.log.exception(e)
+
+    def group_by_file(self, records):
+        '''Formats the messages and returns a list of (filename, hostname, facility, lines) tuples.
+
+        Files are listed in the order they first appear in records, and the
+        lines for each file are in their original order. No file is opened here.'''
+
+        batches = {} # filename -> (filename, hostname, facility, lines)
+        result = []
+
+        for facility, msg in records:
+            try:
+                hostname = msg['hostname']
+                filename = self.get_filename(hostname, facility)
+
+                batch = batches.get(filename)
+                if batch is None:
+                    batch = batches[filename] = (filename, hostname, facility, [])
+                    result.append(batch)
+
+                batch[3].append(self.format_line(msg))
+            except Exception as e:
+                self.log.error('An error occured writing message: {0!r}'.format(msg))
+                self.log.exception(e)
+
+        return result
+
+    def format_line(self, msg):
+        '''Formats the message as a line of the log file. Returns a bytestring.
 
-        log_file.write(s)
+        A client timestamp that cannot be formatted is replaced with the
+        server time, and nsecs is clamped to 0..999999999.'''
+
+        timestamp = None
+
+        if self.timestamp == 'client':
+            try:
+                nsecs = min(max(int(msg['nsecs']), 0), 999999999)
+                timestamp = self.format_timestamp(int(msg['stamp']), nsecs // 1000)
+            except (TypeError, ValueError, OverflowError):
+                self.log.warning('Invalid timestamp {0!r}.{1!r} from {2}, using the server time instead'.format(
+                    msg['stamp'], msg['nsecs'], msg['hostname']))
+
+        if timestamp is None:
+            now = time.time()
+            stamp = int(now)
+            timestamp = self.format_timestamp(stamp, int((now - stamp) * 1000000))
+
+        return b''.join((
+            timestamp,
+            self.FIELD_SEPARATOR,
+            to_bytes(msg['hostname']),
+            self.FIELD_SEPARATOR,
+            to_bytes(msg['body']),
+            b'\n',
+        ))
+
+    def format_timestamp(self, stamp, usecs):
+        '''Formats a local time as YYYY-MM-DD HH:MM:SS.ffffff. Returns a bytestring.
+
+        The part up to the seconds is only formatted once per second.'''
+
+        second, prefix = self.timestamp_cache
+        if second != stamp:
+            prefix = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp)).encode('ascii')
+            self.timestamp_cache = (stamp, prefix)
+
+        return b'%s.%06d' % (prefix, usecs)
 
     def get_filename(self, hostname, facility):
         '''Returns the log filename given a hostname.'''
@@ -204,29 +757,215 @@ class Writer(object):
 
         filename = self.get_filename(hostname, facility)
 
-        if filename not in self.files:
-            self.files[filename] = LogFile(
+        log_file = self.open_files.pop(filename, None)
+        if log_file is not None:
+            with self.stats_lock:
+                self.hits += 1
+            self.open_files[filename] = log_file # Most recently used
+            return log_file
+
+        with self.stats_lock:
+            self.misses += 1
+
+        if self.max_open_files > 0:
+            while len(self.open_files) >= self.max_open_files:
+                self.evict()
+
+        log_file = self.files.get(filename)
+        if log_file is not None:
+            log_file.open_file()
+        else:
+            log_file = self.files[filename] = LogFile(
                 filename=filename,
                 scheduler=self.scheduler,
                 compressor=self.compressor,
                 backup_count=facility.backup_count,
                 max_size=facility.max_size,
                 rotate=facility.rotate,
-                flush_every=facility.flush_every
+                flush_every=facility.flush_every,
+                flush_interval=facility.flush_interval,
+                buffer_bytes=facility.buffer_bytes,
+                durability=facility.durability,
+                sync_histogram=self.get_sync_histogram(facility),
+                backups=self.backups,
+                bucket=facility.bucket,
+                preallocate=facility.preallocate
             )
 
-        return self.files[filename] 
+            # Catch up with a rotation missed while loghogd was not running
+            # before anything is written
+            log_file.do_rotate()
+            self.schedule_rotation(log_file, time.time())
+
+        self.open_files[filename] = log_file
+        return log_file
+
+    def rotate_file(self, log_file):
+        '''Rotates the file if it is due, keeping its place in the rotation schedule.'''
+
+        deadline = log_file.next_rotation_at
+        log_file.do_rotate()
+
+        if log_file.next_rotation_at != deadline:
+            self.schedule_rotation(log_file, time.time())
+
+    def schedule_rotation(self, log_file, now):
+        '''Adds the file's next rotation time to the heap used by rotate_due().
+
+        A file whose rotation is overdue, because the last attempt failed, is
+        checked again after TICK_INTERVAL.'''
+
+        if log_file.next_rotation_at is None:
+            return # Only rotated by size
+
+        heapq.heappush(self.rotations, (max(log_file.next_rotation_at, now + self.TICK_INTERVAL), log_file.filename))
+
+    def rotate_due(self):
+        '''Rotates the files whose rotation time has passed.
+
+        Idle files are rotated as well, and handed to the compressor on time.
+        Files closed to save file descriptors are closed again afterwards, and
+        forgotten until they are written to again, so that files of hosts that
+        are gone do not stay in files forever.'''
+
+        now = time.time()
+
+        with self.lock:
+            while self.rotations and self.rotations[0][0] <= now:
+                _, filename = heapq.heappop(self.rotations)
+
+                log_file = self.files.get(filename)
+                if log_file is None or log_file.next_rotation_at > now:
+                    continue # Forgotten by a reload, or rotated already
+
+                was_open = log_file.is_open()
+                try:
+                    log_file.do_rotate()
+                except Exception as e:
+                    self.log.error('An error occured rotating {0}'.format(filename))
+                    self.log.exception(e)
+                finally:
+                    if not was_open:
+                        log_file.close()
+
+                if not was_open and log_file.next_rotation_at > now:
+                    del self.files[filename]
+                    continue
+
+                self.schedule_rotation(log_file, now)
+
+    def evict(self):
+        '''Closes the least recently used file. Its LogFile is kept, with its rotation state.'''
+
+        filename, log_file = self.open_files.popitem(last=False)
+        with self.stats_lock:
+            self.evictions += 1
+
+        log_file.close()
+
+    def get_sync_histogram(self, facility):
+        '''Returns the fdatasync() latency histogram shared by all the files of the facility.'''
+
+        name = '{0}:{1}'.format(facility.app_id, facility.mod_str)
+
+        with self.stats_lock:
+            histogram = self.sync_histograms.get(name)
+            if histogram is None:
+                histogram = self.sync_histograms[name] = LatencyHistogram()
+
+        return histogram
+
+    def log_stats(self):
+        '''Logs the open file cache counters, fsync latencies and the rotation backlog, then resets them.
+
+        Only takes self.stats_lock, so it never waits for a write or a sync in progress.'''
+
+        with self.stats_lock:
+            hits, misses, evictions = self.hits, self.misses, self.evictions
+            self.hits = self.misses = self.evictions = 0
+            histograms = sorted(self.sync_histograms.items())
+
+        self.log.info('Open files: {0} of {1} known. Cache hits: {2}, misses: {3}, evictions: {4}.'.format(
+            len(self.open_files), len(self.files), hits, misses, evictions))
+
+        for name, histogram in histograms:
+            histogram = histogram.take()
+            if histogram.count():
+                self.log.info('fdatasync latency for {0}: {1}.'.format(name, histogram.format()))
+
+        backlog, processed, max_delay = self.backups.get_stats()
+        if processed or backlog:
+            self.log.info('Rotation backlog: {0} backups waiting. Handled {1}, longest wait {2:.2f}s.'.format(backlog, processed, max_delay))
+
+        if self.max_open_files > 0 and evictions > hits:
+            self.log.warning('Most writes reopened a file. Consider raising writer.max_open_files.')
+
+    def tick(self):
+        '''Does the writer's periodic work.
+
+        Rotates the files that are due, flushes stale files and syncs files of
+        durability = interval facilities. It should be called every TICK_INTERVAL
+        seconds from the main loop. In write-behind mode this does nothing: the
+        writer thread takes care of it, so that the main loop never waits for the disk.'''
+
+        if self.thread:
+            return
+
+        self.rotate_due()
+        self.flush_stale()
+        self.sync_files()
+
+    def flush_stale(self):
+        '''Flushes files whose buffered data is older than their flush_interval.'''
+
+        now = time.time()
+
+        with self.lock:
+            for log_file in self.open_files.values():
+                if not log_file.is_stale(now):
+                    continue
+
+                try:
+                    log_file.flush()
+                except Exception as e:
+                    self.log.error('An error occured flushing {0}'.format(log_file.filename))
+                    self.log.exception(e)
 
     def reload(self):
         '''Closes and re-opens all files. Useful during a config reload.'''
 
-        self.close()
+        self.close_files()
 
     def close(self):
+        '''Writes out everything still queued, stops the write-behind thread and closes all files.'''
+
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+        self.close_files()
+        self.backups.shutdown()
+
+    def close_files(self):
         '''Close all files.'''
 
-        for filename, log_file in self.files.items():
-            log_file.close()
+        with self.lock:
+            for filename, log_file in self.open_files.items():
+                log_file.close()
+
+                del self.open_files[filename]
+
+            self.files.clear()
+            self.rotations = []
+
+def to_bytes(value):
+    '''Returns value as a UTF-8 bytestring.'''
+
+    if isinstance(value, bytes):
+        return value
 
-            del self.files[filename]
+    if not isinstance(value, unicode):
+        value = unicode(value)
 
+    return value.encode('utf8')
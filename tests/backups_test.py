@@ -0,0 +1,121 @@
+import unittest, tempfile, shutil, os
+from backups import BackupIndex, BackupManager
+from writer_test import PassthroughCompressor
+
+class BackupIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.index = BackupIndex()
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def touch(self, name):
+        filename = os.path.join(self.log_dir, name)
+        open(filename, 'w').close()
+        return filename
+
+    def listdir(self):
+        return sorted(os.listdir(self.log_dir))
+
+    def test_scan(self):
+        self.touch('root.log')
+        self.touch('root.log.2013-01-01-00-00-00-000000.xz')
+        self.touch('root.log.2013-01-02-00-00-00-000000')
+        self.touch('root.web.log.2013-01-01-00-00-00-000000.gz')
+        self.touch('root.log.old')
+
+        self.assertEqual({
+            'root.log': ['root.log.2013-01-01-00-00-00-000000', 'root.log.2013-01-02-00-00-00-000000'],
+            'root.web.log': ['root.web.log.2013-01-01-00-00-00-000000'],
+        }, self.index.get_dir(self.log_dir))
+
+    def test_remove_old(self):
+        self.touch('root.log.2013-01-01-00-00-00-000000.xz')
+        self.touch('root.log.2013-01-02-00-00-00-000000.xz')
+        self.touch('root.web.log.2013-01-01-00-00-00-000000')
+        self.index.get_dir(self.log_dir)
+
+        # Compressed after it was indexed
+        self.index.add(os.path.join(self.log_dir, 'root.log'), self.touch('root.log.2013-01-03-00-00-00-000000'))
+        os.rename(os.path.join(self.log_dir, 'root.log.2013-01-03-00-00-00-000000'), os.path.join(self.log_dir, 'root.log.2013-01-03-00-00-00-000000.xz'))
+        self.index.add(os.path.join(self.log_dir, 'root.log'), self.touch('root.log.2013-01-04-00-00-00-000000'))
+
+        self.index.remove_old(os.path.join(self.log_dir, 'root.log'), 2)
+
+        self.assertEqual([
+            'root.log.2013-01-03-00-00-00-000000.xz',
+            'root.log.2013-01-04-00-00-00-000000',
+            'root.web.log.2013-01-01-00-00-00-000000',
+        ], self.listdir())
+        self.assertEqual(2, len(self.index.get_dir(self.log_dir)['root.log']))
+
+    def test_add_twice(self):
+        filename = os.path.join(self.log_dir, 'root.log')
+        backup = self.touch('root.log.2013-01-01-00-00-00-000000')
+
+        self.index.add(filename, backup)
+        self.index.add(filename, backup)
+
+        self.assertEqual(['root.log.2013-01-01-00-00-00-000000'], self.index.get_dir(self.log_dir)['root.log'])
+
+    def test_pattern(self):
+        self.touch('root.log.2013-01-01')
+        self.touch('root.log.2013-01-02.xz')
+        self.touch('root.log.2013-01-03')
+        self.touch('root.log.2013-01-04-00-00-00-000000')
+        self.assertEqual(['root.log.2013-01-04-00-00-00-000000'], self.index.get_dir(self.log_dir)['root.log'])
+
+        self.index.add_pattern('%Y-%m-%d')
+        self.assertEqual(4, len(self.index.get_dir(self.log_dir)['root.log']))
+
+        # The file being written to is not counted
+        self.index.remove_old(os.path.join(self.log_dir, 'root.log'), 1, current=os.path.join(self.log_dir, 'root.log.2013-01-04-00-00-00-000000'))
+        self.assertEqual(['root.log.2013-01-03', 'root.log.2013-01-04-00-00-00-000000'], self.listdir())
+
+    def test_missing_dir(self):
+        self.index.remove_old(os.path.join(self.log_dir, 'app', 'root.log'), 2)
+        self.assertEqual({}, self.index.get_dir(os.path.join(self.log_dir, 'app')))
+
+class BackupManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.compressor = PassthroughCompressor()
+        self.manager = BackupManager(self.compressor)
+
+    def tearDown(self):
+        self.manager.shutdown()
+        shutil.rmtree(self.log_dir)
+
+    def rotate(self, stamp):
+        filename = os.path.join(self.log_dir, 'root.log')
+        backup = '{0}.2013-01-{1:02d}-00-00-00-000000'.format(filename, stamp)
+        open(backup, 'w').close()
+
+        self.manager.add(filename, backup, 2)
+        return backup
+
+    def test_without_thread(self):
+        backups = [self.rotate(day) for day in range(1, 4)]
+
+        self.assertEqual(backups, self.compressor.compressed)
+        self.assertEqual([os.path.basename(b) for b in backups[1:]], sorted(os.listdir(self.log_dir)))
+        self.assertEqual((0, 3), self.manager.get_stats()[:2])
+
+    def test_thread(self):
+        self.manager.start()
+
+        backups = [self.rotate(day) for day in range(1, 4)]
+        self.manager.shutdown()
+
+        self.assertEqual(backups, self.compressor.compressed)
+        self.assertEqual([os.path.basename(b) for b in backups[1:]], sorted(os.listdir(self.log_dir)))
+
+        backlog, processed, max_delay = self.manager.get_stats()
+        self.assertEqual((0, 3), (backlog, processed))
+        self.assertTrue(max_delay >= 0)
+
+        # Reset by get_stats()
+        self.assertEqual((0, 0, 0.0), self.manager.get_stats())
@@ -0,0 +1,46 @@
+'''Helpers shared by the *_bench.py scripts.
+
+Importing this module makes the loghogd modules and the test helpers
+importable, so it must be imported before them.
+'''
+
+from __future__ import print_function
+import sys, os, time, tempfile, shutil
+from contextlib import contextmanager
+
+curdir = os.path.abspath(os.path.dirname(__file__))
+sys.path = [curdir, os.path.join(os.path.dirname(curdir), 'loghogd')] + sys.path
+
+def get_arg(index, default, convert=int):
+    '''Returns the command line argument at index, converted, or default if it is not given.'''
+
+    return convert(sys.argv[index]) if len(sys.argv) > index else default
+
+def report(label, n, elapsed, nbytes=None):
+    '''Prints how many messages, and MB if nbytes is given, were handled per second.'''
+
+    line = '{0:<30} {1:>10.0f} msg/s'.format(label, n / elapsed)
+    if nbytes is not None:
+        line += ' {0:>8.1f} MB/s'.format(nbytes / elapsed / 1024 / 1024)
+
+    print(line)
+
+def bench(label, func, items):
+    '''Calls func with each of items and reports the rate.'''
+
+    start = time.time()
+    for item in items:
+        func(item)
+    elapsed = time.time() - start
+
+    report(label, len(items), elapsed)
+
+@contextmanager
+def temp_dir():
+    '''Yields a temporary directory, removed with its contents afterwards.'''
+
+    workdir = tempfile.mkdtemp()
+    try:
+        yield workdir
+    finally:
+        shutil.rmtree(workdir)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+'''Compares the JSON decoders available on this system on realistic message payloads.
+
+Usage: python decoder_bench.py [number of messages]
+'''
+
+from __future__ import print_function
+import json, random
+
+from benchutil import bench, get_arg
+from decoder import available_decoders
+from processor import Processor
+from processor_test import StaticFacilityDB
+
+BODIES = [
+    u'GET /api/v1/users/{0}/profile HTTP/1.1 200 1532 0.{0:04d}s',
+    u'Connection pool exhausted, waiting for a free connection (pool=db-{0}, waiters=3)',
+    u'Traceback (most recent call last):\n  File "app.py", line {0}, in handle\nKeyError: \'user\'',
+    u'Benutzer {0} hat sich angemeldet – Sitzung geöffnet',
+]
+
+def make_payloads(n):
+    payloads = []
+    for i in xrange(n):
+        t = 1358363502 + i
+        payloads.append(json.dumps({
+            'version': 1,
+            'app_id': 'app-name',
+            'module': 'web.foo',
+            'stamp': t,
+            'nsecs': random.randint(0, 999999999),
+            'hostname': 'web{0}.example.com'.format(i % 8),
+            'body': random.choice(BODIES).format(i),
+        }))
+
+    return payloads
+
+def main():
+    n = get_arg(1, 100000)
+    payloads = make_payloads(n)
+
+    print('Decoding {0} messages.'.format(n))
+    for name, loads in available_decoders():
+        bench(name, loads, payloads)
+
+    print()
+    print('Processor.prepare_message, facility without a secret:')
+    for name, _ in available_decoders():
+        processor = Processor(StaticFacilityDB(), None, json_decoder=name)
+        bench(name, lambda payload: processor.prepare_message(payload, None), payloads)
+
+if __name__ == '__main__':
+    main()
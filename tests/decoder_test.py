@@ -0,0 +1,19 @@
+import unittest
+from decoder import create_decoder, available_decoders, DecoderError
+
+class DecoderTest(unittest.TestCase):
+
+    def test_auto(self):
+        name, loads = create_decoder('auto')
+
+        self.assertEqual(name, available_decoders()[0][0])
+        self.assertEqual({u'body': u'hello'}, loads(b'{"body": "hello"}'))
+
+    def test_json(self):
+        name, loads = create_decoder('json')
+
+        self.assertEqual('json', name)
+        self.assertRaises(ValueError, loads, b'{"body": ')
+
+    def test_invalid(self):
+        self.assertRaises(DecoderError, create_decoder, 'yaml')
@@ -1,6 +1,6 @@
 
 import unittest, os
-from facilities import FacilityDB, FacilityError, pretty_mod_id, parse_mod_id
+from facilities import Facility, FacilityDB, FacilityError, pretty_mod_id, parse_mod_id
 
 class FacilitiesTest(unittest.TestCase):
  
@@ -79,10 +79,60 @@ class FacilitiesTest(unittest.TestCase):
         f = self.db.get_facility('no-such-app', '')
         self.assertEqual(f, None)
     
+    def test_facility_search_memo(self):
+        f = self.db.get_facility('app-name', 'web.does-not-exist')
+        self.assertTrue(f is self.db.get_facility('app-name', 'web.does-not-exist'))
+        self.assertTrue(f is self.db.get_facility('app-name', ('root', 'web')))
+
+        self.assertEqual(None, self.db.get_facility('no-such-app', 'web'))
+        self.assertTrue(('no-such-app', 'web') in self.db.state[1])
+
+    def test_facility_search_memo_bounded(self):
+        db = FacilityDB(cache_size=2)
+        db.add_facility(Facility('app-name', ('root', ), 'daily', 14))
+
+        for mod_str in ('a', 'b', 'c', 'd'):
+            self.assertEqual(('root', ), db.get_facility('app-name', mod_str).mod_id)
+            self.assertTrue(len(db.state[1]) <= 2)
+
+    def test_facility_search_memo_reload(self):
+        f = self.db.get_facility('app-name', 'web')
+        self.db.reload()
+
+        g = self.db.get_facility('app-name', 'web')
+        self.assertEqual(f.mod_id, g.mod_id)
+        self.assertFalse(f is g)
+
     def test_root_inheritance(self):
         f = self.db.get_facility('app-name', 'web')
         self.assertEqual(f.secret, 'foo')
 
+    def test_digest_inheritance(self):
+        self.assertEqual('sha256', self.db.get_facility('app-name', 'web').digest)
+        self.assertEqual('md5', self.db.get_facility('app-name', 'web.errors').digest)
+
+    def test_invalid_digest(self):
+        self.assertRaises(FacilityError, Facility, 'app-name', ('root', ), 'daily', 14, secret='foo', digest='crc32')
+
+    def test_durability_inheritance(self):
+        self.assertEqual('interval', self.db.get_facility('app-name', 'web').durability)
+        self.assertEqual('every', self.db.get_facility('app-name', 'web.errors').durability)
+
+    def test_invalid_durability(self):
+        self.assertRaises(FacilityError, Facility, 'app-name', ('root', ), 'daily', 14, durability='always')
+
+    def test_bucket(self):
+        self.assertEqual('%Y-%m-%d', self.db.get_facility('app-name', 'web').bucket)
+        self.assertEqual(None, self.db.get_facility('app-name', 'web.errors').bucket)
+
+    def test_invalid_bucket(self):
+        self.assertRaises(FacilityError, Facility, 'app-name', ('root', ), 'daily', 14, bucket='daily')
+        self.assertRaises(FacilityError, Facility, 'app-name', ('root', ), 'daily', 14, bucket='%Y/%m/%d')
+        self.assertRaises(FacilityError, Facility, 'app-name', ('root', ), 'size', 14, max_size=1024, bucket='%Y-%m-%d')
+
+    def test_invalid_preallocate(self):
+        self.assertRaises(FacilityError, Facility, 'app-name', ('root', ), 'daily', 14, preallocate=True)
+
     def test_no_root_config(self):
         filename = os.path.join(os.path.dirname(__file__), 'data', 'facilities-with-no-root.conf')
         self.assertRaises(FacilityError, self.db.load_config, filename)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+'''Measures the cost of verifying message signatures.
+
+Compares computing HMAC from scratch for every message, which is what
+Processor.verify_signature used to do, with copying a cached keyed HMAC.
+
+Usage: python hmac_bench.py [number of messages]
+'''
+
+from __future__ import print_function
+import hmac
+
+from benchutil import bench, get_arg
+from processor import Processor
+from facilities import Facility
+
+SECRET = 'my-big-secret'
+
+def make_messages(n, digest):
+    messages = []
+    for i in xrange(n):
+        msg = {
+            'version': 1,
+            'app_id': 'bench-app',
+            'module': 'web',
+            'stamp': 1358363502 + i,
+            'nsecs': i * 7919 % 1000000000,
+            'hostname': 'web{0}.example.com'.format(i % 8),
+            'body': u'GET /api/v1/users/{0}/profile HTTP/1.1 200 1532 – ok'.format(i),
+        }
+
+        hashable = u''.join(unicode(msg[field]) for field in Processor.HASHABLE_FIELDS).encode('utf-8')
+        msg['signature'] = unicode(hmac.new(SECRET, hashable, Facility.DIGESTS[digest]).hexdigest())
+
+        messages.append(msg)
+
+    return messages
+
+def verify_uncached(msg, digestmod):
+    '''The original implementation.'''
+
+    hashable = u''.join(unicode(msg[field]) for field in Processor.HASHABLE_FIELDS).encode('utf-8')
+    signature = hmac.new(SECRET, hashable, digestmod).hexdigest()
+
+    if signature != msg['signature']:
+        raise ValueError('Invalid signature')
+
+def main():
+    n = get_arg(1, 100000)
+    processor = Processor(None, None, json_decoder='json')
+
+    for digest in sorted(Facility.DIGESTS):
+        messages = make_messages(n, digest)
+        digestmod = Facility.DIGESTS[digest]
+        facility = Facility('bench-app', ('root', 'web'), 'daily', 1, secret=SECRET, digest=digest)
+
+        print('HMAC-{0}, {1} messages:'.format(digest.upper(), n))
+        bench('uncached', lambda msg: verify_uncached(msg, digestmod), messages)
+        bench('cached keyed HMAC', lambda msg: processor.verify_signature(SECRET, msg, digest, facility.keyed_hmac), messages)
+        print()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+
+import unittest, threading, time
+from pipeline import Pipeline, PipelineStartupError
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processed = []
+        self.pipeline = Pipeline(self.processed.extend, queue_size=2, threads=1, stream_overflow='block', dgram_overflow='drop')
+
+    def test_invalid_overflow_policy(self):
+        self.assertRaises(PipelineStartupError, Pipeline, None, queue_size=2, threads=1, stream_overflow='spill', dgram_overflow='drop')
+
+    def test_drop_when_full(self):
+        # Processing threads are not running yet, so the queue fills up
+        self.pipeline.submit_dgram([('a', None)])
+        self.pipeline.submit_dgram([('b', None)])
+        self.pipeline.submit_dgram([('c', None), ('d', None)])
+
+        self.assertEqual(2, self.pipeline.high_water)
+        self.assertEqual(2, self.pipeline.dropped)
+
+        self.pipeline.start()
+        self.pipeline.close()
+
+        self.assertEqual([('a', None), ('b', None)], self.processed)
+
+    def test_block_when_full(self):
+        self.assertTrue(self.pipeline.submit_stream([('a', None)]))
+        self.assertTrue(self.pipeline.submit_stream([('b', None)]))
+
+        # Refused without waiting, so that the caller can submit it again later
+        self.assertFalse(self.pipeline.submit_stream([('c', None)]))
+
+        self.pipeline.start()
+        while not self.pipeline.submit_stream([('c', None)]):
+            time.sleep(0.01)
+        self.pipeline.close()
+
+        self.assertEqual([('a', None), ('b', None), ('c', None)], self.processed)
+        self.assertEqual(0, self.pipeline.dropped)
+
+    def test_ordered_per_address(self):
+        processed = {}
+        lock = threading.Lock()
+
+        def callback(batch):
+            time.sleep(0.001) # Give the other threads a chance to overtake
+            with lock:
+                for msg, addr in batch:
+                    processed.setdefault(addr, []).append((msg, threading.current_thread()))
+
+        pipeline = Pipeline(callback, queue_size=100, threads=4, stream_overflow='block', dgram_overflow='drop')
+        pipeline.start()
+
+        addrs = [('127.0.0.1', port) for port in range(40000, 40008)]
+        for i in range(20):
+            for addr in addrs:
+                self.assertTrue(pipeline.submit_stream([(i, addr)]))
+        pipeline.close()
+
+        for addr in addrs:
+            self.assertEqual(list(range(20)), [msg for msg, _ in processed[addr]])
+            self.assertEqual(1, len(set(thread for _, thread in processed[addr])))
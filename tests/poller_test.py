@@ -0,0 +1,51 @@
+
+import unittest, socket, select
+from poller import create_poller, PollerError, POLL_READ, POLL_WRITE
+
+class PollerTest(unittest.TestCase):
+
+    POLLERS = [name for name, attr in (('epoll', 'epoll'), ('poll', 'poll'), ('select', 'select')) if hasattr(select, attr)]
+
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_create_poller_auto(self):
+        self.assertEqual(self.POLLERS[0], create_poller('auto').name)
+
+    def test_create_poller_invalid(self):
+        self.assertRaises(PollerError, create_poller, 'kqueue-or-bust')
+
+    def test_readable(self):
+        for name in self.POLLERS:
+            poller = create_poller(name)
+            poller.register(self.a.fileno(), POLL_READ)
+
+            self.assertEqual([], list(poller.poll(0)), name)
+
+            self.b.send(b'x')
+            self.assertEqual([(self.a.fileno(), POLL_READ)], list(poller.poll(1)), name)
+
+            # Level-triggered: still readable until the data is consumed
+            self.assertEqual([(self.a.fileno(), POLL_READ)], list(poller.poll(1)), name)
+            self.a.recv(1)
+            self.assertEqual([], list(poller.poll(0)), name)
+
+            poller.close()
+
+    def test_modify_and_unregister(self):
+        for name in self.POLLERS:
+            poller = create_poller(name)
+            poller.register(self.a.fileno(), POLL_READ)
+            poller.modify(self.a.fileno(), POLL_WRITE)
+            self.assertEqual([(self.a.fileno(), POLL_WRITE)], list(poller.poll(1)), name)
+
+            poller.unregister(self.a.fileno())
+            poller.unregister(self.a.fileno()) # Unknown descriptors are ignored
+            self.assertEqual([], list(poller.poll(0)), name)
+
+            poller.close()
+
@@ -0,0 +1,68 @@
+'''Measures sustained append throughput with and without preallocation.
+
+Writes messages to a LogFile that is rotated by size, flushing after every
+message, once growing the file as data is appended and once with max_size
+bytes preallocated by fallocate(). The number of extents of the last
+file is listed when filefrag is installed. Run it on the file system the
+logs are written to, e.g. with TMPDIR=/var/log/loghogd.
+
+Usage: python prealloc_bench.py [number of messages] [max_size in MB] [durability]
+'''
+
+from __future__ import print_function
+import os, time, subprocess
+
+from benchutil import report, get_arg, temp_dir
+from writer import LogFile
+from backups import BackupManager
+from writer_test import PassthroughCompressor, MemoryScheduler
+
+LINE = b'2013-01-16 14:11:42.012043 - web1.example.com - GET /api/v1/users/42/profile HTTP/1.1 200 1532\n'
+
+def count_extents(filename):
+    '''Returns the output of filefrag for the file, or None if it is not installed.'''
+
+    try:
+        with open(os.devnull, 'wb') as devnull:
+            return subprocess.check_output(['filefrag', filename], stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench(label, workdir, n, max_size, durability, preallocate):
+    compressor = PassthroughCompressor()
+    filename = os.path.join(workdir, label, 'root.log')
+    log_file = LogFile(filename, MemoryScheduler(), compressor, 2, max_size, 'size', 1,
+        durability=durability, backups=BackupManager(compressor), preallocate=preallocate)
+
+    if preallocate and not log_file.preallocate:
+        print('{0:<30} not supported here'.format(label))
+        log_file.close()
+        return
+
+    start = time.time()
+    for _ in xrange(n):
+        if log_file.is_full():
+            log_file.do_rotate()
+        log_file.write(LINE)
+    log_file.flush()
+    elapsed = time.time() - start
+
+    extents = count_extents(log_file.filename)
+    log_file.close()
+
+    report(label, n, elapsed, n * len(LINE))
+    if extents:
+        print('    {0}'.format(extents))
+
+def main():
+    n = get_arg(1, 500000)
+    max_size = get_arg(2, 16) * 1024 * 1024
+    durability = get_arg(3, 'none', str)
+
+    with temp_dir() as workdir:
+        print('Appending {0} messages, rotating every {1} bytes, durability = {2}:'.format(n, max_size, durability))
+        bench('growing', workdir, n, max_size, durability, False)
+        bench('preallocated', workdir, n, max_size, durability, True)
+
+if __name__ == '__main__':
+    main()
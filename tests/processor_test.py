@@ -1,16 +1,27 @@
 # -*- coding: utf-8 -*-
 
-import unittest, hmac
+import unittest, hmac, hashlib
 from processor import Processor, LogParseError
+from facilities import Facility
 try:
     import json
 except ImportError:
     import simplejson as json
 
+class StaticFacilityDB(object):
+    def __init__(self):
+        self.facilities = {
+            ('app-name', 'web.foo'): Facility('app-name', ('root', 'web', 'foo'), 'daily', 1),
+            ('secret-app', 'web.foo'): Facility('secret-app', ('root', 'web', 'foo'), 'daily', 1, secret='01WzaGPu'),
+        }
+
+    def get_facility(self, app_id, mod_str):
+        return self.facilities.get((app_id, mod_str))
+
 class FacilitiesTest(unittest.TestCase):
  
     def setUp(self):
-        self.processor = Processor(None, None)
+        self.processor = Processor(StaticFacilityDB(), None, json_decoder='json')
 
     def test_verify_signature_1(self):
         msg = {
@@ -63,6 +74,57 @@ class FacilitiesTest(unittest.TestCase):
         except LogParseError as e:
             self.assertTrue(False, 'verify_signature() raised an error: {0}'.format(e))
 
+    def test_verify_signature_sha256(self):
+        msg = {
+            'app_id': 'app-name',
+            'module': 'web.foo',
+            'stamp': 1358363502,
+            'nsecs': 12043,
+            'body': u'If numbers aren’t beautiful, I don’t know what is. –Paul Erdős',
+        }
+
+        secret = '01WzaGPu'
+
+        hashable = u''.join(unicode(msg[field]) for field in self.processor.HASHABLE_FIELDS).encode('utf-8')
+        msg['signature'] = unicode(hmac.new(secret, hashable, hashlib.sha256).hexdigest())
+
+        try:
+            self.processor.verify_signature(secret, msg, 'sha256')
+        except LogParseError as e:
+            self.assertTrue(False, 'verify_signature() raised an error: {0}'.format(e))
+
+        # An MD5 signature is not accepted in place of SHA-256 and vice versa
+        self.assertRaises(LogParseError, self.processor.verify_signature, secret, msg, 'md5')
+
+    def test_verify_signature_keyed_hmac(self):
+        facility = Facility('secret-app', ('root', ), 'daily', 1, secret='01WzaGPu', digest='sha256')
+        pristine = facility.keyed_hmac.hexdigest()
+
+        msgs = []
+        for body in (u'first', u'second'):
+            msg = {'app_id': 'secret-app', 'module': 'root', 'stamp': 1358363502, 'nsecs': 12043, 'body': body}
+            hashable = u''.join(unicode(msg[field]) for field in self.processor.HASHABLE_FIELDS).encode('utf-8')
+            msg['signature'] = hmac.new(facility.secret, hashable, hashlib.sha256).hexdigest()
+            msgs.append(msg)
+
+        for msg in msgs:
+            self.processor.verify_signature(facility.secret, msg, facility.digest, facility.keyed_hmac)
+
+        # The keyed HMAC is copied, never updated
+        self.assertEqual(pristine, facility.keyed_hmac.hexdigest())
+
+        msgs[1]['signature'] = msgs[0]['signature']
+        self.assertRaises(LogParseError, self.processor.verify_signature, facility.secret, msgs[1], facility.digest, facility.keyed_hmac)
+
+    def test_verify_signature_not_a_string(self):
+        msg = {'app_id': 'secret-app', 'module': 'web.foo', 'stamp': 1358363502, 'nsecs': 12043, 'body': u'hi', 'signature': 42}
+        self.assertRaises(LogParseError, self.processor.verify_signature, '01WzaGPu', msg)
+
+        # Logged as a signature error, and still written
+        msg.update(version=1, hostname='example.com')
+        facility, parsed = self.processor.prepare_message(json.dumps(msg), None)
+        self.assertEqual(u'hi', parsed['body'])
+
     def test_parse_message_1(self):
         msg = {
             'app_id': 'app-name',
@@ -101,3 +163,51 @@ class FacilitiesTest(unittest.TestCase):
         
         msg_str = json.dumps(msg)
         self.assertRaises(LogParseError, self.processor.parse_message, msg_str)
+
+    def test_prepare_message_no_secret(self):
+        msg = {
+            'app_id': 'app-name',
+            'module': 'web.foo',
+            'stamp': 1358363502,
+            'nsecs': 12043,
+            'body': u'If numbers aren’t beautiful, I don’t know what is. –Paul Erdős',
+            'version': 1,
+            'hostname': 'example.com',
+        }
+
+        facility, parsed = self.processor.prepare_message(json.dumps(msg), None)
+
+        self.assertEqual('app-name', facility.app_id)
+        self.assertEqual(('root', 'web', 'foo'), facility.mod_id)
+        self.assertEqual(msg, parsed)
+
+    def test_prepare_message_secret(self):
+        msg = {
+            'app_id': 'secret-app',
+            'module': 'web.foo',
+            'stamp': 1358363502,
+            'nsecs': 12043,
+            'body': u'If numbers aren’t beautiful, I don’t know what is. –Paul Erdős',
+            'version': 1,
+            'hostname': 'example.com',
+        }
+
+        hashable = u''.join(unicode(msg[field]) for field in self.processor.HASHABLE_FIELDS).encode('utf-8')
+        msg['signature'] = hmac.new('01WzaGPu', hashable).hexdigest()
+
+        _, parsed = self.processor.prepare_message(json.dumps(msg), None)
+
+        self.assertEqual(msg['signature'], parsed['signature'])
+
+    def test_prepare_message_unknown_facility(self):
+        msg = {
+            'app_id': 'no-such-app',
+            'module': 'web.foo',
+            'stamp': 1358363502,
+            'nsecs': 12043,
+            'body': u'Hello',
+            'version': 1,
+            'hostname': 'example.com',
+        }
+
+        self.assertEqual(None, self.processor.prepare_message(json.dumps(msg), None))
@@ -0,0 +1,58 @@
+'''Measures the per-message cost of checking log files for rotation.
+
+Compares asking the dbm-backed Scheduler for the next rotation time on
+every message, which is what LogFile.should_rotate used to do, with the
+deadline that LogFile now computes when the file is opened.
+
+Usage: python rotation_bench.py [number of messages]
+'''
+
+from __future__ import print_function
+import os, time
+
+from benchutil import report, get_arg, temp_dir
+from writer import LogFile
+from scheduler import Scheduler
+from writer_test import PassthroughCompressor
+
+LINE = b'2013-01-16 14:11:42.012043 - web1.example.com - GET /api/v1/users/42/profile HTTP/1.1 200 1532\n'
+
+class LegacyLogFile(LogFile):
+    '''LogFile with the original rotation check.'''
+
+    def should_rotate(self):
+        if self.max_size:
+            if self.size >= self.max_size:
+                return 'max_size'
+
+        now = time.time()
+
+        next_rotation_at = self.scheduler.get_next_execution(self.filename, self.rotate, now)
+
+        if next_rotation_at < now:
+            return self.rotate
+
+def bench(label, cls, workdir, n):
+    scheduler = Scheduler(workdir=workdir)
+    log_file = cls(os.path.join(workdir, label, 'root.log'), scheduler, PassthroughCompressor(), 14, None, '0 0 * * *', 1000)
+
+    start = time.time()
+    for _ in xrange(n):
+        log_file.do_rotate()
+        log_file.write(LINE)
+    elapsed = time.time() - start
+
+    log_file.close()
+
+    report(label, n, elapsed)
+
+def main():
+    n = get_arg(1, 100000)
+
+    with temp_dir() as workdir:
+        print('Writing {0} messages with daily rotation:'.format(n))
+        bench('scheduler per message', LegacyLogFile, workdir, n)
+        bench('cached deadline', LogFile, workdir, n)
+
+if __name__ == '__main__':
+    main()
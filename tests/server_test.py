@@ -1,14 +1,14 @@
 # -*- coding: utf-8 -*-
 
-import unittest, struct, zlib
-from server import Server
+import unittest, struct, zlib, socket, tempfile, shutil, os, stat
+from server import Server, StreamBuffer, ServerError, ServerStartupError, open_unix_listeners, close_unix_listeners
 
 class ServerTest(unittest.TestCase):
     
     FORMAT_PROTO = '!LL %ds'
  
     def setUp(self):
-        self.server = Server(None, conf_root='', listen_ipv4='', listen_ipv6='', listen_ipv4_ssl='', listen_ipv6_ssl='', default_port=0, default_port_ssl=0, pemfile='', cacert='')
+        self.server = Server(None, conf_root='', listen_ipv4='', listen_ipv6='', listen_ipv4_ssl='', listen_ipv6_ssl='', default_port=0, default_port_ssl=0, pemfile='', cacert='', poller='auto', udp_batch_size=2, udp_rcvbuf=0, ssl_handshake_timeout=10, unix_listeners=[])
 
     def test_parse_datagram_1(self):
         payload = u"That is one hot jalapño!".encode('utf-8')
@@ -42,3 +42,227 @@ class ServerTest(unittest.TestCase):
 
         self.assertEqual(orig_payload, res_payload)
 
+    def pack_batch(self, payloads):
+        return b''.join(struct.pack('!L', len(p)) + p for p in payloads)
+
+    def test_parse_datagram_batch(self):
+        payloads = [u"That is one hot jalapño!".encode('utf-8'), b'', b'third']
+        batch = self.pack_batch(payloads)
+
+        buf = struct.pack(self.FORMAT_PROTO % len(batch), len(batch), 0x02, batch)
+        res_payload, offset = self.server.parse_datagram(buf)
+
+        self.assertEqual(payloads, res_payload)
+        self.assertEqual(len(buf), offset)
+
+    def test_parse_datagram_batch_gzip(self):
+        payloads = [b'first', b'second']
+        batch = zlib.compress(self.pack_batch(payloads))
+
+        buf = struct.pack(self.FORMAT_PROTO % len(batch), len(batch), 0x03, batch)
+        res_payload, _ = self.server.parse_datagram(buf)
+
+        self.assertEqual(payloads, res_payload)
+
+    def test_parse_datagram_batch_truncated(self):
+        batch = self.pack_batch([b'first'])[:-1]
+
+        buf = struct.pack(self.FORMAT_PROTO % len(batch), len(batch), 0x02, batch)
+        self.assertRaises(ServerError, self.server.parse_datagram, buf)
+
+    def test_parse_datagram_offset(self):
+        payloads = [b'first', b'second', b'third']
+        buf = bytearray(b''.join(struct.pack(self.FORMAT_PROTO % len(p), len(p), 0, p) for p in payloads))
+
+        offset = 0
+        for payload in payloads:
+            res_payload, offset = self.server.parse_datagram(buf, offset)
+            self.assertEqual(payload, res_payload)
+
+        self.assertEqual(len(buf), offset)
+        self.assertEqual((None, offset), self.server.parse_datagram(buf, offset))
+
+    def test_parse_datagram_zlib_stream(self):
+        compressor = zlib.compressobj()
+        stream = StreamBuffer(16)
+
+        data = b''
+        for payload in (b'GET /index.html 200', b'GET /index.html 404', b'GET /index.html 200'):
+            chunk = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            data += struct.pack(self.FORMAT_PROTO % len(chunk), len(chunk), Server._FLAGS_ZLIB_STREAM, chunk)
+
+        offset, res = 0, []
+        while offset < len(data):
+            payload, offset = self.server.parse_datagram(data, offset, stream=stream)
+            res.append(payload)
+
+        self.assertEqual([b'GET /index.html 200', b'GET /index.html 404', b'GET /index.html 200'], res)
+        self.assertEqual(57, stream.decompressed_bytes)
+        self.assertEqual(len(data) - 3 * self.server.HEADER_SIZE, stream.compressed_bytes)
+        self.assertTrue(stream.compression_ratio() > 0)
+
+    def test_parse_datagram_zlib_stream_ended(self):
+        stream = StreamBuffer(16)
+
+        # The end of the stream, then more data: in the same frame, or in the next one
+        for chunks in ([zlib.compress(b'first') + b'trailing'], [zlib.compress(b'first'), zlib.compress(b'second')]):
+            stream.decompressor = None
+
+            def parse_all():
+                for chunk in chunks:
+                    frame = struct.pack(self.FORMAT_PROTO % len(chunk), len(chunk), Server._FLAGS_ZLIB_STREAM, chunk)
+                    self.server.parse_datagram(frame, stream=stream)
+
+            self.assertRaises(ServerError, parse_all)
+
+    def test_parse_datagram_zlib_stream_dgram(self):
+        payload = zlib.compress(b'hello')
+        buf = struct.pack(self.FORMAT_PROTO % len(payload), len(payload), Server._FLAGS_ZLIB_STREAM, payload)
+
+        self.assertRaises(ServerError, self.server.parse_datagram, buf)
+
+    def test_stream_buffer(self):
+        a, b = socket.socketpair()
+        buf = StreamBuffer(16)
+
+        try:
+            a.sendall(b'x' * 24)
+            self.assertEqual(24, buf.recv_into(b, 24))
+            self.assertEqual(24, len(buf))
+
+            # Consume most of the buffer; the remainder is moved to the front
+            buf.start = 20
+            a.sendall(b'y' * 20)
+            self.assertEqual(20, buf.recv_into(b, 20))
+            self.assertEqual(0, buf.start)
+            self.assertEqual(b'xxxx' + b'y' * 20, bytes(buf.data[buf.start:buf.end]))
+        finally:
+            a.close()
+            b.close()
+
+    def test_recv_datagrams(self):
+        server = Server(None, conf_root='', listen_ipv4='127.0.0.1', listen_ipv6='', listen_ipv4_ssl='', listen_ipv6_ssl='', default_port=0, default_port_ssl=0, pemfile='', cacert='', poller='auto', udp_batch_size=2, udp_rcvbuf=0, ssl_handshake_timeout=10, unix_listeners=[])
+        sock = list(server.dgram_socks)[0]
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+        try:
+            for payload in (b'one', b'two', b'three'):
+                client.sendto(struct.pack(self.FORMAT_PROTO % len(payload), len(payload), 0, payload), sock.getsockname())
+
+            # At most udp_batch_size datagrams are read at a time, until the socket is drained
+            self.assertEqual([b'one', b'two'], [p for p, addr in server.recv_datagrams(sock)])
+            self.assertEqual([b'three'], [p for p, addr in server.recv_datagrams(sock)])
+            self.assertEqual([], server.recv_datagrams(sock))
+        finally:
+            client.close()
+            server.close()
+
+    def test_pause_when_refused(self):
+        batches = []
+        accept = [False]
+
+        def callback(batch):
+            if not accept[0]:
+                return False
+            batches.append(batch)
+
+        server = Server(callback, conf_root='', listen_ipv4='', listen_ipv6='', listen_ipv4_ssl='', listen_ipv6_ssl='', default_port=0, default_port_ssl=0, pemfile='', cacert='', poller='auto', udp_batch_size=2, udp_rcvbuf=0, ssl_handshake_timeout=10, unix_listeners=[])
+        a, b = socket.socketpair()
+
+        try:
+            server.client_socket_addrs[a] = 'peer'
+            server.add_client_stream(a)
+
+            payload = b'first'
+            b.sendall(struct.pack(self.FORMAT_PROTO % len(payload), len(payload), 0, payload))
+            server.run_once(1)
+
+            # The batch is kept and the socket is not read any more, without waiting
+            self.assertEqual([[(b'first', 'peer')]], [batch for _, batch in server.paused.values()])
+            self.assertEqual(server.RESUME_INTERVAL, server.get_poll_timeout())
+
+            payload = b'second'
+            b.sendall(struct.pack(self.FORMAT_PROTO % len(payload), len(payload), 0, payload))
+            server.run_once(0)
+            self.assertEqual([], batches)
+
+            accept[0] = True
+            server.run_once(0) # Resumed
+            server.run_once(1) # Reads the rest
+
+            self.assertEqual([[(b'first', 'peer')], [(b'second', 'peer')]], batches)
+            self.assertEqual({}, server.paused)
+        finally:
+            b.close()
+            server.close()
+
+    def test_timers(self):
+        calls = []
+        self.server.add_timer(0, lambda: calls.append(1))
+        self.server.add_timer(60, lambda: calls.append(60))
+
+        self.assertEqual(0, self.server.get_poll_timeout())
+
+        self.server.run_timers()
+        self.assertEqual([1], calls)
+
+        self.server.run_once(0)
+        self.assertEqual([1, 1], calls)
+
+    def test_expire_handshakes(self):
+        a, b = socket.socketpair()
+
+        try:
+            self.server.client_socket_addrs[a] = ('127.0.0.1', 1234)
+            self.server.handshakes[a] = 0 # Long overdue
+            self.server.add_socket(a)
+
+            self.server.expire_handshakes()
+
+            self.assertEqual({}, self.server.handshakes)
+            self.assertEqual({}, self.server.client_socket_addrs)
+            self.assertEqual({}, self.server.socks)
+        finally:
+            b.close()
+
+    def test_unix_listeners(self):
+        tmpdir = tempfile.mkdtemp()
+        stream_path = os.path.join(tmpdir, 'stream.sock')
+        dgram_path = os.path.join(tmpdir, 'dgram.sock')
+
+        # A socket file left behind by a process that died
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(stream_path)
+        stale.close()
+
+        got = []
+        listeners = open_unix_listeners('', listen_unix_stream=stream_path, listen_unix_dgram=dgram_path, unix_socket_mode='0660', unix_socket_owner='', unix_socket_group='')
+        server = Server(got.extend, conf_root='', listen_ipv4='', listen_ipv6='', listen_ipv4_ssl='', listen_ipv6_ssl='', default_port=0, default_port_ssl=0, pemfile='', cacert='', poller='auto', udp_batch_size=2, udp_rcvbuf=0, ssl_handshake_timeout=10, unix_listeners=listeners)
+
+        try:
+            self.assertEqual(0o660, stat.S_IMODE(os.stat(dgram_path).st_mode))
+
+            # Still in use, so it must not be removed
+            self.assertRaises(ServerStartupError, open_unix_listeners, '', listen_unix_stream=stream_path, listen_unix_dgram='', unix_socket_mode='0660', unix_socket_owner='', unix_socket_group='')
+
+            payload = b'local'
+            frame = struct.pack(self.FORMAT_PROTO % len(payload), len(payload), 0, payload)
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            client.sendto(frame, dgram_path)
+            client.close()
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            client.connect(stream_path)
+            client.sendall(frame)
+
+            for _ in range(3):
+                server.run_once(0.1)
+            client.close()
+
+            self.assertEqual([(b'local', dgram_path), (b'local', stream_path)], got)
+        finally:
+            server.close()
+            close_unix_listeners(listeners)
+            self.assertFalse(os.path.exists(stream_path))
+            shutil.rmtree(tmpdir)
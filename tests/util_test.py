@@ -1,6 +1,6 @@
 
 import unittest
-from util import parse_addrs
+from util import parse_addrs, parse_unix_addrs, pretty_addr, LatencyHistogram
 
 class UtilTest(unittest.TestCase):
     
@@ -28,3 +28,26 @@ class UtilTest(unittest.TestCase):
         res = tuple(parse_addrs('[::1]:8888,[::2]:9999,[::3]', 8888))
         self.assertEqual(res, ({'host': '::1', 'port': 8888}, {'host': '::2', 'port': 9999}, {'host': '::3', 'port': 8888}))
 
+    def test_parse_unix_addrs(self):
+        res = tuple(parse_unix_addrs('/var/run/loghogd/stream.sock, /tmp/loghog.sock'))
+        self.assertEqual(res, ({'filename': '/var/run/loghogd/stream.sock'}, {'filename': '/tmp/loghog.sock'}))
+
+    def test_pretty_addr_unix(self):
+        self.assertEqual('/tmp/loghog.sock', pretty_addr('/tmp/loghog.sock'))
+        self.assertEqual('unnamed UNIX socket', pretty_addr(''))
+        self.assertEqual('unnamed UNIX socket', pretty_addr(None))
+
+    def test_latency_histogram(self):
+        h = LatencyHistogram()
+        self.assertEqual('no samples', h.format())
+
+        for seconds in (0.0005, 0.0015, 0.0016, 3.0):
+            h.add(seconds)
+
+        self.assertEqual(4, h.count())
+        self.assertEqual([1, 2, 0, 0, 0, 0, 0, 0, 0, 0, 1], h.counts)
+        self.assertEqual('4 samples, avg 750.90ms, max 3000.00ms (<1ms: 1, <2ms: 2, >=1000ms: 1)', h.format())
+
+        copy = h.take()
+        self.assertEqual(4, copy.count())
+        self.assertEqual(0, h.count())
@@ -0,0 +1,162 @@
+
+import unittest, socket, threading, time
+from workers import WorkerPool, WorkerError, RemoteWriter
+from facilities import FacilityDB, Facility
+
+class RecordingWriter(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def write_many(self, records):
+        self.messages.extend(records)
+
+class WorkersTest(unittest.TestCase):
+
+    def setUp(self):
+        self.facility_db = FacilityDB()
+        self.root = Facility('app-name', ('root', ), 'daily', 1)
+        self.web = Facility('app-name', ('root', 'web'), 'daily', 1)
+        self.facility_db.add_facility(self.root)
+        self.facility_db.add_facility(self.web)
+
+        self.writer = RecordingWriter()
+        self.pool = WorkerPool(1, self.facility_db, self.writer, None)
+
+    def test_invalid_num_workers(self):
+        self.assertRaises(WorkerError, WorkerPool, 0, self.facility_db, self.writer, None)
+
+    def test_worker_died(self):
+        pool = WorkerPool(1, self.facility_db, self.writer, lambda remote_writer: None)
+        pool.start()
+
+        try:
+            deadline = time.time() + 5
+            while pool.workers and time.time() < deadline:
+                pool.reap()
+                time.sleep(0.01)
+
+            # Not replaced
+            self.assertEqual({}, pool.workers)
+            self.assertTrue(pool.failed)
+            self.assertTrue(pool.closed)
+        finally:
+            pool.poller.close()
+
+    def test_timers(self):
+        calls = []
+        self.pool.add_timer(0, lambda: calls.append(1))
+        self.pool.add_timer(60, lambda: calls.append(60))
+
+        self.assertEqual(0, self.pool.get_poll_timeout())
+
+        self.pool.run_timers()
+        self.assertEqual([1], calls)
+        self.assertTrue(self.pool.get_poll_timeout() <= self.pool.CHECK_INTERVAL)
+
+    def test_remote_write(self):
+        worker_sock, parent_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        parent_sock.setblocking(0)
+
+        try:
+            remote_writer = RemoteWriter(worker_sock)
+            remote_writer.write_many([(self.web, {u'hostname': u'example.com', u'body': u'first'})])
+            remote_writer.write_many([(self.root, {u'hostname': u'example.com', u'body': u'second'})])
+
+            self.pool.drain(parent_sock)
+
+            self.assertEqual([
+                (self.web, {u'hostname': u'example.com', u'body': u'first'}),
+                (self.root, {u'hostname': u'example.com', u'body': u'second'}),
+            ], self.writer.messages)
+        finally:
+            worker_sock.close()
+            parent_sock.close()
+
+    def test_remote_write_many_split(self):
+        worker_sock, parent_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        parent_sock.setblocking(0)
+
+        try:
+            remote_writer = RemoteWriter(worker_sock)
+            remote_writer.MAX_PACKET_SIZE = 200 # Forces the batch to be split into several packets
+
+            records = [(self.root, {u'body': u'message {0}'.format(i)}) for i in range(20)]
+            remote_writer.write_many(records)
+
+            self.pool.drain(parent_sock)
+
+            self.assertEqual(records, self.writer.messages)
+        finally:
+            worker_sock.close()
+            parent_sock.close()
+
+    def test_remote_write_unknown_facility(self):
+        worker_sock, parent_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        parent_sock.setblocking(0)
+
+        try:
+            remote_writer = RemoteWriter(worker_sock)
+            remote_writer.write_many([(Facility('removed-app', ('root', ), 'daily', 1), {u'body': u'lost'})])
+            remote_writer.write_many([(self.root, {u'body': u'kept'})])
+
+            self.pool.drain(parent_sock)
+
+            self.assertEqual([(self.root, {u'body': u'kept'})], self.writer.messages)
+        finally:
+            worker_sock.close()
+            parent_sock.close()
+
+    def test_remote_write_large_record(self):
+        worker_sock, parent_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        parent_sock.setblocking(0)
+
+        try:
+            remote_writer = RemoteWriter(worker_sock)
+            body = u'x' * (150 * 1024) # Larger than WorkerPool.RECV_SIZE and the socket buffers
+
+            # The worker blocks until the parent has read enough of the packet
+            sender = threading.Thread(target=remote_writer.write_many, args=([(self.root, {u'body': body}), (self.web, {u'body': u'small'})], ))
+            sender.start()
+
+            deadline = time.time() + 5
+            while len(self.writer.messages) < 2 and time.time() < deadline:
+                self.pool.drain(parent_sock)
+                time.sleep(0.01)
+            sender.join()
+
+            self.assertEqual([(self.root, {u'body': body}), (self.web, {u'body': u'small'})], self.writer.messages)
+            self.assertEqual(0, len(self.pool.buffers[parent_sock.fileno()]))
+        finally:
+            worker_sock.close()
+            parent_sock.close()
+
+    def test_remote_write_concurrent(self):
+        worker_sock, parent_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        parent_sock.setblocking(0)
+
+        try:
+            remote_writer = RemoteWriter(worker_sock)
+
+            # Records large enough that each packet takes several send() calls
+            def send(n):
+                for i in range(5):
+                    remote_writer.write_many([(self.root, {u'body': u'{0}-{1}'.format(n, i) * 20000})])
+
+            senders = [threading.Thread(target=send, args=(n, )) for n in range(4)]
+            for sender in senders:
+                sender.start()
+
+            deadline = time.time() + 10
+            while len(self.writer.messages) < 20 and time.time() < deadline:
+                self.pool.drain(parent_sock)
+                time.sleep(0.001)
+            for sender in senders:
+                sender.join()
+
+            expected = set(u'{0}-{1}'.format(n, i) * 20000 for n in range(4) for i in range(5))
+            self.assertEqual(20, len(self.writer.messages))
+            self.assertEqual(expected, set(msg[u'body'] for _, msg in self.writer.messages))
+        finally:
+            worker_sock.close()
+            parent_sock.close()
@@ -0,0 +1,536 @@
+# -*- coding: utf-8 -*-
+
+import unittest, tempfile, shutil, os, time, datetime, threading
+from writer import Writer, WriterError
+from facilities import FacilityDB, Facility
+
+class PassthroughCompressor(object):
+    '''Stands in for Compressor with compress_on_write disabled.'''
+
+    def __init__(self):
+        self.compressed = []
+
+    def compress(self, filename):
+        self.compressed.append(filename)
+
+    def wrap_fileobj(self, f, filename):
+        return f
+
+    def wrap_filename(self, filename):
+        return filename
+
+    def counts_uncompressed_size(self):
+        return False
+
+    def unwrap_filename(self, filename):
+        return filename
+
+class MemoryScheduler(object):
+    '''Stands in for the dbm-backed Scheduler.'''
+
+    def __init__(self):
+        self.db = {}
+
+    def get_next_execution(self, job_id, schedule, now):
+        self.db.setdefault(job_id, now)
+        return self.db[job_id] + 3600
+
+    def get_last_execution(self, job_id):
+        return self.db[job_id]
+
+    def record_execution(self, job_id, now):
+        self.db[job_id] = now
+
+class WriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+
+        self.root = Facility('app', ('root', ), 'daily', 2)
+        self.web = Facility('app', ('root', 'web'), 'daily', 2, file_per_host=True)
+
+        self.facility_db = FacilityDB()
+        self.facility_db.add_facility(self.root)
+        self.facility_db.add_facility(self.web)
+
+        self.compressor = PassthroughCompressor()
+        self.writer = Writer(self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='server', queue_size=0, commit_interval=0, max_open_files=0)
+
+    def tearDown(self):
+        self.writer.close()
+        shutil.rmtree(self.log_dir)
+
+    def read_lines(self, name):
+        with open(os.path.join(self.log_dir, 'app', name)) as f:
+            return [line.rstrip('\n').split(' - ', 2)[1:] for line in f]
+
+    def test_write_many_grouped(self):
+        records = [
+            (self.root, {'hostname': 'a', 'body': u'one'}),
+            (self.web, {'hostname': 'a', 'body': u'two'}),
+            (self.root, {'hostname': 'b', 'body': u'three'}),
+            (self.web, {'hostname': 'b', 'body': u'four'}),
+            (self.web, {'hostname': 'a', 'body': u'five'}),
+        ]
+
+        groups = self.writer.group_by_file(records)
+        self.assertEqual(3, len(groups))
+        self.assertEqual([2, 2, 1], [len(lines) for _, _, _, lines in groups])
+        self.assertEqual({}, self.writer.files)
+
+        self.writer.write_many(records)
+        self.writer.close()
+
+        self.assertEqual([['a', 'one'], ['b', 'three']], self.read_lines('root.log'))
+        self.assertEqual([['a', 'two'], ['a', 'five']], self.read_lines('a-web.log'))
+        self.assertEqual([['b', 'four']], self.read_lines('b-web.log'))
+
+    def test_write_many_bad_record(self):
+        records = [
+            (self.root, {'body': u'no hostname'}),
+            (self.root, {'hostname': 'a', 'body': u'ok'}),
+        ]
+
+        self.writer.write_many(records)
+        self.writer.close()
+
+        self.assertEqual([['a', 'ok']], self.read_lines('root.log'))
+
+    def file_size(self, name):
+        return os.path.getsize(os.path.join(self.log_dir, 'app', name))
+
+    def test_buffer_bytes(self):
+        facility = Facility('app', ('root', 'buffered'), 'daily', 2, flush_every=1000, buffer_bytes=100)
+        records = [(facility, {'hostname': 'a', 'body': u'x' * 20})]
+
+        self.writer.write_many(records)
+        self.assertEqual(0, self.file_size('buffered.log'))
+
+        # Three lines are over 100 bytes and go out in a single write
+        self.writer.write_many(records * 2)
+        self.assertTrue(self.file_size('buffered.log') > 100)
+
+        log_file = self.writer.files.values()[0]
+        self.assertEqual([], log_file.buffer)
+
+    def test_flush_interval(self):
+        facility = Facility('app', ('root', 'buffered'), 'daily', 2, flush_every=1000, flush_interval=0.5)
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'hello'})])
+
+        self.writer.tick()
+        self.assertEqual(0, self.file_size('buffered.log'))
+
+        log_file = self.writer.files.values()[0]
+        log_file.buffered_since = time.time() - 1
+
+        self.writer.tick()
+        self.assertEqual([['a', 'hello']], self.read_lines('buffered.log'))
+
+    def test_close_flushes(self):
+        facility = Facility('app', ('root', 'buffered'), 'daily', 2, flush_every=1000)
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'hello'})])
+        self.writer.close()
+
+        self.assertEqual([['a', 'hello']], self.read_lines('buffered.log'))
+
+    def test_running_size(self):
+        facility = Facility('app', ('root', 'sized'), 'size', 2, max_size=1000)
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'hello'})] * 3)
+
+        log_file = self.writer.files.values()[0]
+        self.assertEqual(self.file_size('sized.log'), log_file.size)
+
+        # Reopening picks up the size on disk
+        self.writer.close()
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'hello'})])
+
+        log_file = self.writer.files.values()[0]
+        self.assertEqual(self.file_size('sized.log'), log_file.size)
+
+    def test_rotation_deadline(self):
+        records = [(self.root, {'hostname': 'a', 'body': u'hello'})]
+        self.writer.write_many(records)
+
+        log_file = self.writer.files.values()[0]
+        self.assertTrue(log_file.next_rotation_at > time.time())
+
+        # The deadline is only read from the scheduler when the file is opened
+        self.writer.scheduler.db[log_file.filename] -= 7200
+        self.writer.write_many(records)
+        self.assertEqual(1, len(os.listdir(os.path.join(self.log_dir, 'app'))))
+
+        # Rotation by schedule is left to tick()
+        log_file.next_rotation_at = time.time() - 1
+        self.writer.write_many(records)
+        self.assertEqual(1, len(os.listdir(os.path.join(self.log_dir, 'app'))))
+
+        self.writer.rotations = [(log_file.next_rotation_at, log_file.filename)]
+        self.writer.tick()
+
+        self.assertEqual(2, len(os.listdir(os.path.join(self.log_dir, 'app'))))
+        self.assertTrue(log_file.next_rotation_at > time.time())
+        self.assertEqual([(log_file.next_rotation_at, log_file.filename)], self.writer.rotations)
+
+        self.writer.write_many(records)
+        self.assertEqual([['a', 'hello']], self.read_lines('root.log'))
+
+    def test_rotate_closes_outside_lock(self):
+        facility = Facility('app', ('root', 'durable'), 'daily', 2, durability='interval')
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'hello'})])
+        log_file = self.writer.files.values()[0]
+        self.assertTrue(log_file.unsynced)
+
+        # Hold up the BackupManager's thread
+        self.writer.backups.start()
+        release = threading.Event()
+        self.writer.backups.submit(release.wait)
+
+        log_file.next_rotation_at = time.time() - 1
+        self.writer.rotations = [(log_file.next_rotation_at, log_file.filename)]
+        self.writer.rotate_due()
+
+        # Swapped, but neither synced nor compressed yet
+        backup = [f for f in os.listdir(os.path.join(self.log_dir, 'app')) if f != 'durable.log'][0]
+        self.assertEqual([['a', 'hello']], self.read_lines(backup))
+        self.assertTrue(log_file.is_open())
+        self.assertEqual(0, log_file.sync_histogram.count())
+        self.assertEqual([], self.compressor.compressed)
+
+        release.set()
+        self.writer.backups.shutdown()
+
+        # Synced and closed before compression
+        self.assertEqual(1, log_file.sync_histogram.count())
+        self.assertEqual([os.path.join(self.log_dir, 'app', backup)], self.compressor.compressed)
+
+    def test_rotate_idle(self):
+        writer = Writer(self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='server', queue_size=0, commit_interval=0, max_open_files=1)
+
+        try:
+            writer.write_many([(self.web, {'hostname': 'a', 'body': u'hello'})])
+            writer.write_many([(self.web, {'hostname': 'b', 'body': u'hello'})])
+
+            log_file = writer.files[os.path.join(self.log_dir, 'app', 'a-web.log')]
+            self.assertFalse(log_file.is_open())
+
+            log_file.next_rotation_at = time.time() - 1
+            writer.rotations = [(log_file.next_rotation_at, log_file.filename)]
+            writer.tick()
+
+            # Rotated and handed to the compressor, then forgotten
+            self.assertFalse(log_file.is_open())
+            self.assertEqual(1, len(self.compressor.compressed))
+            self.assertEqual([], self.read_lines('a-web.log'))
+            self.assertFalse(log_file.filename in writer.files)
+            self.assertEqual([], writer.rotations)
+
+            # Picked up again when written to
+            writer.write_many([(self.web, {'hostname': 'a', 'body': u'again'})])
+            self.assertEqual([['a', 'again']], self.read_lines('a-web.log'))
+        finally:
+            writer.close()
+
+    def test_rotate_empty(self):
+        self.writer.write_many([(self.root, {'hostname': 'a', 'body': u'hello'})])
+        log_file = self.writer.files.values()[0]
+
+        for _ in range(2):
+            log_file.next_rotation_at = time.time() - 1
+            self.writer.rotations = [(log_file.next_rotation_at, log_file.filename)]
+            self.writer.tick()
+
+            # Only rescheduled the second time
+            self.assertTrue(log_file.next_rotation_at > time.time())
+            self.assertEqual(1, len(self.writer.rotations))
+
+        self.assertEqual(1, len(self.compressor.compressed))
+        self.assertEqual(2, len(os.listdir(os.path.join(self.log_dir, 'app'))))
+
+    def test_rotate_empty_bucket(self):
+        facility = Facility('app', ('root', 'db'), 'daily', 2, bucket='%Y-%m-%d')
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'hello'})])
+        log_file = self.writer.files.values()[0]
+        first_path = log_file.path
+
+        for name in ('db.log.b', 'db.log.c'):
+            path = os.path.join(self.log_dir, 'app', name)
+            log_file.get_bucket_path = lambda now: path
+            log_file.next_rotation_at = time.time() - 1
+            self.writer.rotations = [(log_file.next_rotation_at, log_file.filename)]
+            self.writer.tick()
+
+        # The empty db.log.b was removed instead of being kept as a backup
+        self.assertEqual([first_path], self.compressor.compressed)
+        self.assertEqual(sorted(['db.log', os.path.basename(first_path), 'db.log.c']), sorted(os.listdir(os.path.join(self.log_dir, 'app'))))
+
+    def test_rotate_on_open(self):
+        # A file left behind from before a missed rotation
+        os.makedirs(os.path.join(self.log_dir, 'app'))
+        filename = os.path.join(self.log_dir, 'app', 'root.log')
+        with open(filename, 'w') as f:
+            f.write('old\n')
+        self.writer.scheduler.record_execution(filename, time.time() - 7200)
+
+        self.writer.write_many([(self.root, {'hostname': 'a', 'body': u'hello'})])
+
+        self.assertEqual(1, len(self.compressor.compressed))
+        self.assertEqual([['a', 'hello']], self.read_lines('root.log'))
+
+    def test_bucket(self):
+        facility = Facility('app', ('root', 'db'), 'daily', 2, max_size=10, bucket='%Y-%m-%d')
+        records = [(facility, {'hostname': 'a', 'body': u'hello'})]
+
+        self.writer.write_many(records)
+        log_file = self.writer.files[os.path.join(self.log_dir, 'app', 'db.log')]
+
+        bucket_name = 'db.log.{0}'.format(time.strftime('%Y-%m-%d'))
+        self.assertEqual(bucket_name, os.readlink(log_file.filename))
+        self.assertEqual(os.path.join(self.log_dir, 'app', bucket_name), log_file.path)
+
+        # Not rotated by size, and no scheduler state
+        self.writer.write_many(records)
+        self.assertEqual([['a', 'hello'], ['a', 'hello']], self.read_lines('db.log'))
+        self.assertFalse(log_file.filename in self.writer.scheduler.db)
+
+        next_path = os.path.join(self.log_dir, 'app', 'db.log.next')
+        log_file.get_bucket_path = lambda now: next_path
+        log_file.next_rotation_at = time.time() - 1
+        self.writer.rotations = [(log_file.next_rotation_at, log_file.filename)]
+        self.writer.tick()
+
+        self.assertEqual('db.log.next', os.readlink(log_file.filename))
+        self.assertEqual([os.path.join(self.log_dir, 'app', bucket_name)], self.compressor.compressed)
+        self.assertTrue(log_file.next_rotation_at > time.time())
+
+        self.writer.write_many(records)
+        self.assertEqual([['a', 'hello']], self.read_lines('db.log'))
+        self.assertEqual(2, len(self.read_lines(bucket_name)))
+
+    def test_rotate_by_size(self):
+        facility = Facility('app', ('root', 'sized'), 'size', 2, max_size=50)
+        records = [(facility, {'hostname': 'a', 'body': u'x' * 40})]
+
+        self.writer.write_many(records)
+        log_file = self.writer.files.values()[0]
+        self.assertEqual(None, log_file.next_rotation_at)
+
+        self.writer.write_many(records)
+
+        self.assertEqual(2, len(os.listdir(os.path.join(self.log_dir, 'app'))))
+        self.assertEqual(1, len(self.read_lines('sized.log')))
+
+    def test_preallocate(self):
+        facility = Facility('app', ('root', 'sized'), 'size', 2, max_size=1024 * 1024, preallocate=True)
+        records = [(facility, {'hostname': 'a', 'body': u'hello'})]
+
+        self.writer.write_many(records)
+        log_file = self.writer.files.values()[0]
+        if not log_file.preallocate:
+            return # Not supported here
+
+        st = os.stat(log_file.filename)
+        self.assertTrue(st.st_blocks * 512 >= facility.max_size)
+        self.assertTrue(st.st_size < 100)
+
+        log_file.size = facility.max_size
+        self.writer.write_many(records)
+
+        # The backup only keeps the space it uses, the new file is preallocated
+        backup = [f for f in os.listdir(os.path.join(self.log_dir, 'app')) if f != 'sized.log'][0]
+        self.assertTrue(os.stat(os.path.join(self.log_dir, 'app', backup)).st_blocks * 512 < facility.max_size)
+        self.assertTrue(os.stat(log_file.filename).st_blocks * 512 >= facility.max_size)
+        self.assertEqual([['a', 'hello']], self.read_lines(backup))
+        self.assertEqual([['a', 'hello']], self.read_lines('sized.log'))
+
+    def test_preallocate_evicted(self):
+        facility = Facility('app', ('root', 'sized'), 'daily', 2, max_size=1024 * 1024, preallocate=True)
+        writer = Writer(self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='server', queue_size=0, commit_interval=0, max_open_files=1)
+
+        try:
+            writer.write_many([(facility, {'hostname': 'a', 'body': u'hello'})])
+            log_file = writer.files[os.path.join(self.log_dir, 'app', 'sized.log')]
+            if not log_file.preallocate:
+                return # Not supported here
+
+            # Evicting the file releases its space
+            writer.write_many([(self.web, {'hostname': 'a', 'body': u'hello'})])
+            self.assertFalse(log_file.is_open())
+            self.assertTrue(os.stat(log_file.filename).st_blocks * 512 < facility.max_size)
+
+            log_file.next_rotation_at = time.time() - 1
+            writer.rotations = [(log_file.next_rotation_at, log_file.filename)]
+            writer.tick()
+        finally:
+            writer.close()
+
+        backup = [f for f in os.listdir(os.path.join(self.log_dir, 'app')) if f.startswith('sized.log.')][0]
+        self.assertTrue(os.stat(os.path.join(self.log_dir, 'app', backup)).st_blocks * 512 < facility.max_size)
+        self.assertEqual([['a', 'hello']], self.read_lines(backup))
+
+        # Closed on shutdown, the new file does not keep its space either
+        self.assertTrue(os.stat(log_file.filename).st_blocks * 512 < facility.max_size)
+
+    def test_format_line(self):
+        before = datetime.datetime.now().replace(microsecond=0)
+        line = self.writer.format_line({'hostname': u'example.com', 'body': u'Paul Erdős'})
+        after = datetime.datetime.now()
+
+        stamp, hostname, body = line.split(b' - ')
+
+        self.assertTrue(before <= datetime.datetime.strptime(stamp, '%Y-%m-%d %H:%M:%S.%f') <= after)
+        self.assertEqual(b'example.com', hostname)
+        self.assertEqual(u'Paul Erdős\n'.encode('utf-8'), body)
+
+    def test_format_line_client_timestamp(self):
+        writer = Writer(self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='client', queue_size=0, commit_interval=0, max_open_files=0)
+        stamp = 1358363502
+
+        line = writer.format_line({'hostname': u'example.com', 'body': 42, 'stamp': stamp, 'nsecs': 12043000})
+        expected = datetime.datetime.fromtimestamp(stamp).strftime('%Y-%m-%d %H:%M:%S') + '.012043 - example.com - 42\n'
+        self.assertEqual(expected, line)
+
+        # Same second, from the cache
+        line = writer.format_line({'hostname': u'example.com', 'body': 42, 'stamp': stamp, 'nsecs': 5})
+        self.assertEqual(expected.replace('012043', '000000'), line)
+
+        # Out of range nsecs are clamped
+        line = writer.format_line({'hostname': u'example.com', 'body': 42, 'stamp': stamp, 'nsecs': 5000000000})
+        self.assertEqual(expected.replace('012043', '999999'), line)
+        line = writer.format_line({'hostname': u'example.com', 'body': 42, 'stamp': stamp, 'nsecs': -1})
+        self.assertEqual(expected.replace('012043', '000000'), line)
+
+    def test_format_line_bad_client_timestamp(self):
+        writer = Writer(self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='client', queue_size=0, commit_interval=0, max_open_files=0)
+        today = datetime.date.today().strftime('%Y-%m-%d')
+
+        # The message is still written, with the server time
+        for stamp, nsecs in (('yesterday', 0), (None, 0), (1358363502, 'soon'), (10 ** 30, 0)):
+            line = writer.format_line({'hostname': u'example.com', 'body': 42, 'stamp': stamp, 'nsecs': nsecs})
+            self.assertTrue(line.endswith(' - example.com - 42\n'))
+            self.assertEqual(today, line[:10])
+
+    def test_invalid_timestamp(self):
+        self.assertRaises(WriterError, Writer, self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='gps', queue_size=0, commit_interval=0, max_open_files=0)
+
+    def test_write_behind(self):
+        writer = Writer(self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='server', queue_size=2, commit_interval=60, max_open_files=0)
+        writer.start()
+
+        try:
+            for i in range(10):
+                writer.write_many([(self.root, {'hostname': 'a', 'body': u'line {0}'.format(i)})])
+        finally:
+            writer.close()
+
+        self.assertEqual([['a', 'line {0}'.format(i)] for i in range(10)], self.read_lines('root.log'))
+
+    def test_sync_files(self):
+        writer = Writer(self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='server', queue_size=0, commit_interval=60, max_open_files=0)
+        facility = Facility('app', ('root', 'db'), 'daily', 2, durability='interval')
+
+        try:
+            writer.write_many([(facility, {'hostname': 'a', 'body': u'hello'}), (self.root, {'hostname': 'a', 'body': u'hello'})])
+            log_file = writer.files[os.path.join(self.log_dir, 'app', 'db.log')]
+            root_file = writer.files[os.path.join(self.log_dir, 'app', 'root.log')]
+            self.assertTrue(log_file.unsynced)
+
+            writer.sync_files()
+            self.assertFalse(log_file.unsynced)
+
+            # At most one sync per commit interval
+            writer.write_many([(facility, {'hostname': 'a', 'body': u'hello'})])
+            writer.sync_files()
+            self.assertTrue(log_file.unsynced)
+
+            writer.sync_files(force=True)
+            self.assertFalse(log_file.unsynced)
+
+            # Facilities with durability = none are never synced
+            self.assertTrue(root_file.unsynced)
+        finally:
+            writer.close()
+
+    def test_durability_batch(self):
+        facility = Facility('app', ('root', 'db'), 'daily', 2, flush_every=100, durability='batch')
+
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'line {0}'.format(i)}) for i in range(3)])
+        log_file = self.writer.files[os.path.join(self.log_dir, 'app', 'db.log')]
+
+        # One sync for the whole batch, despite flush_every
+        self.assertFalse(log_file.unsynced)
+        self.assertEqual(1, log_file.sync_histogram.count())
+        self.assertEqual(3, len(self.read_lines('db.log')))
+
+    def test_durability_every(self):
+        facility = Facility('app', ('root', 'db'), 'daily', 2, flush_every=2, durability='every')
+
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'line {0}'.format(i)}) for i in range(3)])
+        log_file = self.writer.files[os.path.join(self.log_dir, 'app', 'db.log')]
+
+        # The batch is flushed and synced as a whole, then every flush_every messages
+        self.assertEqual(0, log_file.dirty_writes)
+        self.assertEqual(1, log_file.sync_histogram.count())
+
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'line 3'})])
+        self.assertEqual(1, log_file.sync_histogram.count())
+        self.writer.write_many([(facility, {'hostname': 'a', 'body': u'line 4'})])
+        self.assertEqual(2, log_file.sync_histogram.count())
+        self.assertFalse(log_file.unsynced)
+
+    def test_log_stats(self):
+        facility = Facility('app', ('root', 'durable'), 'daily', 2, durability='every')
+        for body in (u'line 1', u'line 2'):
+            self.writer.write_many([(facility, {'hostname': 'a', 'body': body})])
+        log_file = self.writer.files.values()[0]
+
+        # Does not wait for a write or a sync holding the writer's lock
+        with self.writer.lock:
+            thread = threading.Thread(target=self.writer.log_stats)
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+        self.assertEqual((0, 0, 0), (self.writer.hits, self.writer.misses, self.writer.evictions))
+        self.assertEqual(0, log_file.sync_histogram.count())
+
+    def test_max_open_files_batch(self):
+        writer = Writer(self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='server', queue_size=0, commit_interval=0, max_open_files=2)
+        hostnames = ['a', 'b', 'c', 'd', 'a', 'c']
+
+        try:
+            # More files in one batch than may be open at once
+            writer.write_many([(self.web, {'hostname': h, 'body': u'hello'}) for h in hostnames])
+            writer.write_many([(self.web, {'hostname': h, 'body': u'again'}) for h in hostnames])
+        finally:
+            writer.close()
+
+        for hostname in ('a', 'c'):
+            self.assertEqual([[hostname, 'hello']] * 2 + [[hostname, 'again']] * 2, self.read_lines('{0}-web.log'.format(hostname)))
+        for hostname in ('b', 'd'):
+            self.assertEqual([[hostname, 'hello'], [hostname, 'again']], self.read_lines('{0}-web.log'.format(hostname)))
+
+    def test_max_open_files(self):
+        writer = Writer(self.facility_db, self.compressor, self.log_dir, scheduler=MemoryScheduler(), timestamp='server', queue_size=0, commit_interval=0, max_open_files=2)
+
+        try:
+            for hostname in ('a', 'b', 'a', 'c', 'b'):
+                writer.write_many([(self.web, {'hostname': hostname, 'body': u'hello'})])
+
+            # a hit, b evicted by c, a evicted by b
+            self.assertEqual((1, 4, 2), (writer.hits, writer.misses, writer.evictions))
+            self.assertEqual(['c-web.log', 'b-web.log'], [os.path.basename(f) for f in writer.open_files])
+            self.assertEqual(3, len(writer.files))
+
+            # Evicted files keep their rotation state
+            log_file = writer.files[os.path.join(self.log_dir, 'app', 'a-web.log')]
+            self.assertFalse(log_file.is_open())
+            log_file.next_rotation_at = deadline = time.time() + 10
+
+            writer.write_many([(self.web, {'hostname': 'a', 'body': u'again'})])
+            self.assertTrue(log_file.is_open())
+            self.assertEqual(deadline, log_file.next_rotation_at)
+        finally:
+            writer.close()
+
+        self.assertEqual([['a', 'hello'], ['a', 'hello'], ['a', 'again']], self.read_lines('a-web.log'))
+        self.assertEqual([['b', 'hello'], ['b', 'hello']], self.read_lines('b-web.log'))